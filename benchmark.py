@@ -0,0 +1,276 @@
+"""
+Benchmarks of the pipeline stages on synthetic data, to compare the performance of versions:
+
+    python benchmark.py --shape 50 512 512 --channels 2 --out benchmark.json
+
+The synthetic timelapse has drifting, growing and dividing archaea-like blobs (a bright
+rim in the membrane channel, a filled core in the dna channel). StarDist is replaced by
+StubModel, which returns star-convex polygons of the thresholded blobs, so that no trained
+weights are needed. For each stage the best wall time of --repeat runs and the peak of the
+memory allocated by Python and numpy (tracemalloc, in a separate run) are recorded. A stage
+that fails is recorded with its error (stages that need its results are skipped).
+"""
+
+import sys
+import json
+import time
+import platform
+import tempfile
+import traceback
+import argparse
+import subprocess
+import tracemalloc
+import numpy as np
+from pathlib import Path
+from scipy import ndimage
+from tifffile import imwrite
+
+from starchaea import (Config, Starchaea, PolygonStore, normalize_timelapse, timelapse_percentiles,
+                       imread_lazy, export_crops, measure_crop, load_polygons)
+from tracking import track_polygons
+
+
+STAGES = ('register_ird', 'register_phase', 'normalize', 'predict', 'track', 'export_crops', 'measure')
+
+
+
+def synthetic_timelapse(shape=(50,256,256), n_channels=2, n_cells=20, radius=5, drift=0.5, growth=0.02, seed=0):
+    """Timelapse (TCYX, uint16) of drifting, growing and dividing blobs, and its ground truth.
+
+    Up to 'n_cells' cells (of radius 'radius' at birth, on a jittered grid) grow by a factor (1+growth) per frame and divide
+    into two (slightly smaller, separated) daughters once they are twice as large in area.
+    The whole field of view drifts by a random walk with steps of 'drift' pixels (std.),
+    cells move independently by a tenth of that.
+    Returns the timelapse and a dict with the drift (T,2) and per-frame cells (n,3) as (y,x,radius).
+    """
+    n_frames, ny, nx = shape
+    rng = np.random.default_rng(seed)
+    r0 = float(radius)
+    # y, x, radius, vy, vx
+    # initial cells on a jittered grid, so that they do not touch
+    grid = np.stack(np.mgrid[4*r0:ny-4*r0:8*r0, 4*r0:nx-4*r0:8*r0], axis=-1).reshape(-1,2)
+    grid = grid[rng.permutation(len(grid))[:n_cells]] + rng.uniform(-r0, r0, (min(n_cells,len(grid)),2))
+    cells = np.column_stack([grid, r0*rng.uniform(1, np.sqrt(2), len(grid)), np.zeros((len(grid),2))])
+    offsets = np.cumsum(np.vstack([np.zeros(2), rng.normal(0, drift, (n_frames-1,2))]), axis=0)
+
+    yy, xx = np.mgrid[:ny,:nx].astype(np.float32)
+    T = np.empty((n_frames, n_channels, ny, nx), np.uint16)
+    truth = dict(drift=offsets, cells=[])
+    for t in range(n_frames):
+        if t > 0:
+            cells[:,:2] += cells[:,3:] + rng.normal(0, drift/10, (len(cells),2))
+            cells[:,2] *= 1 + growth
+            divide = cells[:,2] > r0*np.sqrt(2)
+            if np.any(divide):
+                # daughters move apart (faster than they grow) to stay separated
+                mothers = cells[divide]
+                angle = rng.uniform(0, np.pi, len(mothers))
+                u = np.column_stack([np.sin(angle), np.cos(angle)])
+                d = 0.9 * mothers[:,2,np.newaxis] * u
+                r = 0.6 * mothers[:,2]
+                v = 4 * growth * r0 * u
+                cells = np.vstack([cells[~divide], np.column_stack([mothers[:,:2]+d, r, v]), np.column_stack([mothers[:,:2]-d, r, -v])])
+        truth['cells'].append(cells[:,:3].copy())
+
+        membrane = np.zeros((ny,nx), np.float32)
+        dna = np.zeros((ny,nx), np.float32)
+        for y, x, r in cells[:,:3]:
+            y, x = y + offsets[t,0], x + offsets[t,1]
+            box = (slice(max(0,int(y-2*r)), max(0,int(y+2*r)+1)), slice(max(0,int(x-2*r)), max(0,int(x+2*r)+1)))
+            d = np.sqrt((yy[box]-y)**2 + (xx[box]-x)**2)
+            np.maximum(membrane[box], np.exp(-(d-r)**2/2) + 0.3*(d < r), out=membrane[box])
+            np.maximum(dna[box], np.exp(-d**2/(2*(r/2)**2)), out=dna[box])
+        for c, img in enumerate((membrane, dna)[:n_channels]):
+            T[t,c] = np.clip(rng.poisson(100 + 1000*img), 0, 65535)
+    return T, truth
+
+
+
+class StubModel:
+    """Stand-in for StarDist2D.predict_instances without trained weights.
+
+    Objects are the connected components of the (hole-filled) normalized image above
+    'threshold', described by the star-convex polygon with n_rays rays from their innermost point.
+    """
+
+    name, logdir = 'stub', None
+
+    def __init__(self, n_rays=32, threshold=0.35, max_dist=100):
+        self.n_rays, self.threshold, self.max_dist = n_rays, threshold, max_dist
+
+
+    def predict_instances(self, img, prob_thresh=None, nms_thresh=None, **kwargs):
+        mask = ndimage.binary_fill_holes(img > self.threshold)
+        labels, n = ndimage.label(mask)
+        points = np.array(ndimage.maximum_position(ndimage.distance_transform_edt(mask), labels, np.arange(1,n+1)), float).reshape(-1,2)
+        phi = np.linspace(0, 2*np.pi, self.n_rays, endpoint=False)
+        rays = np.stack([np.sin(phi), np.cos(phi)])
+        steps = np.arange(0, self.max_dist, 0.5)
+        # sample along all rays of all objects, the distance is the first step outside of the object
+        p = points[:,:,np.newaxis,np.newaxis] + rays[np.newaxis,:,:,np.newaxis]*steps
+        p = np.round(p).astype(int)
+        inside = np.all((p >= 0) & (p < np.reshape(img.shape,(1,2,1,1))), axis=1)
+        p = np.where(inside[:,np.newaxis], p, 0)
+        same = inside & (labels[p[:,0],p[:,1]] == np.arange(1,n+1)[:,np.newaxis,np.newaxis])
+        dist = steps[np.argmin(np.concatenate([same, np.zeros(same.shape[:2]+(1,),bool)], axis=-1), axis=-1).clip(1, len(steps)-1)]
+        coord = points[:,:,np.newaxis] + rays[np.newaxis]*dist[:,np.newaxis]
+        polygons = dict(coord=coord.astype(np.float32), points=np.round(points).astype(np.int32), prob=np.ones(n, np.float32))
+        return labels, polygons
+
+
+
+def _track_crops(polygons, tracks, shape, pad=3):
+    # (i, slices, crop_rois) of each track for export_crops, as get_box_for_rois/translate_rois in Process_trackmate.ipynb
+    for i, track in enumerate(tracks):
+        coord = np.stack([polygons[t,k] for t,k in track])
+        vmin = np.min(coord, axis=(0,2)) - pad
+        vmax = np.max(coord, axis=(0,2)) + pad
+        slices = tuple(slice(max(0, int(np.round(a))), min(s, int(np.round(b)))) for a,b,s in zip(vmin,vmax,shape))
+        crop_rois = {}
+        for (t,_), c in zip(track, coord):
+            crop_rois.setdefault(f'{t}_tracked', []).append(c - vmin[:,np.newaxis])
+        yield i, slices, crop_rois
+
+
+def measure(fn, repeat=1, memory=True):
+    """Best wall time of 'repeat' calls of fn() and the peak memory (MB) allocated during another call.
+
+    Returns the result of the last call and a dict with 'seconds' and 'peak_memory_mb'.
+    """
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - t)
+    stats = dict(seconds=min(times))
+    if memory:
+        tracemalloc.start()
+        try:
+            result = fn()
+            stats['peak_memory_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+        finally:
+            tracemalloc.stop()
+    return result, stats
+
+
+def _version():
+    try:
+        out = subprocess.run(['git','describe','--always','--dirty'], cwd=str(Path(__file__).parent),
+                             capture_output=True, text=True, check=True)
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(shape=(50,256,256), n_channels=2, n_cells=20, stages=STAGES, repeat=1, memory=True, workers=1, seed=0):
+    """Run the benchmarks of the given stages on a synthetic timelapse, returns the results as dict."""
+    T, truth = synthetic_timelapse(shape, n_channels, n_cells, seed=seed)
+    n_frames = len(T)
+    results = dict (
+        version  = _version(),
+        date     = time.strftime('%Y-%m-%dT%H:%M:%S'),
+        python   = platform.python_version(),
+        numpy    = np.__version__,
+        platform = platform.platform(),
+        settings = dict(shape=list(shape), n_channels=n_channels, n_cells=n_cells, repeat=repeat, workers=workers, seed=seed),
+        cells    = [len(c) for c in truth['cells']],
+        stages   = {},
+    )
+
+    failed = set()
+    def record(stage, fn, needs=(), timed=True):
+        # run (and time) fn, a failure is recorded as error of the stage instead of ending the benchmarks
+        missing = [s for s in needs if s in failed]
+        if missing:
+            failed.add(stage)
+            results['stages'][stage] = dict(error=f"skipped, {', '.join(missing)} failed")
+            print(f'Skipping {stage}, {", ".join(missing)} failed', flush=True)
+            return None
+        try:
+            if not timed:
+                return fn()
+            print(f'Benchmarking {stage} ...', flush=True)
+            result, stats = measure(fn, repeat, memory)
+        except Exception as e:
+            traceback.print_exc()
+            failed.add(stage)
+            results['stages'][stage] = dict(error=f'{type(e).__name__}: {e}')
+            print(f'  {stage} failed: {type(e).__name__}: {e}', flush=True)
+            return None
+        stats['frames_per_second'] = n_frames / stats['seconds'] if stats['seconds'] > 0 else None
+        results['stages'][stage] = stats
+        print(f"  {stats['seconds']:.3f}s" + (f", peak memory {stats['peak_memory_mb']:.1f} MB" if memory else ''), flush=True)
+        return result
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        file = tmp / 'data' / 'synthetic.tif'
+        file.parent.mkdir()
+        imwrite(str(file), T, imagej=True, metadata={'axes':'TCYX'})
+
+        channel_order = ['membrane','dna'][:n_channels]
+        d = {f: None for f in Config._fields}
+        d.update(base_dir=str(tmp), data_dir='data', registered_dir='registered', results_dir='stardist', model_dir=None,
+                 channel_order=channel_order, channels_segment=['membrane'], channel_track='membrane',
+                 channel_drift_correction='membrane', predict_batch_size=1, drift_correction_downsample=1, manifest_dir=None)
+        for backend in ('ird','phase'):
+            if f'register_{backend}' in stages:
+                app = Starchaea(Config(**{**d, 'drift_correction_backend': backend}))
+                record(f'register_{backend}', lambda: app.register(T, 0))
+
+        if 'normalize' in stages:
+            record('normalize', lambda: normalize_timelapse(T[:,0], 1, 99.8))
+
+        # the steps after prediction need its polygons, hence these stages are always run
+        app = Starchaea(Config(**{**d, 'drift_correction_backend': 'ird'}))
+        app.init()
+        predict = lambda: app._predict_stardist(StubModel(), file, T, 0, None, None, app.stardist_dir/'membrane')
+        rois = record('predict', predict, timed='predict' in stages)
+        polygons = None if rois is None else load_polygons(rois[1])
+
+        track = lambda: track_polygons(polygons)
+        tracks = record('track', track, needs=['predict'], timed='track' in stages)
+        results['tracks'] = None if tracks is None else len(tracks)
+
+        crop_dir = tmp / 'results' / 'crops_synthetic'
+        crop_dir.parent.mkdir()
+        T_lazy = imread_lazy(file)
+        def export():
+            timelapse = normalize_timelapse(T_lazy, 1, 99.8, clip=True)
+            export_crops(T_lazy, timelapse, _track_crops(polygons, tracks, T.shape[-2:]), crop_dir, 'synthetic', 'TCYX',
+                         workers=workers, total=len(tracks))
+        if 'export_crops' in stages or 'measure' in stages:
+            record('export_crops', export, needs=['track'], timed='export_crops' in stages)
+
+        if 'measure' in stages:
+            crops = lambda: [(crop_dir/'tifs'/f'synthetic_crop_{i:03}.tif', crop_dir/'polygons'/f'synthetic_crop_{i:03}.npz') for i in range(len(tracks))]
+            record('measure', lambda: [measure_crop(tif, rois) for tif, rois in crops()], needs=['export_crops'])
+
+    return results
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic data.')
+    parser.add_argument('--shape', type=int, nargs=3, default=(50,256,256), metavar=('T','Y','X'))
+    parser.add_argument('--channels', type=int, default=2, choices=(1,2))
+    parser.add_argument('--cells', type=int, default=20)
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=1, help='processes for the crop export')
+    parser.add_argument('--no-memory', action='store_true', help='skip the (slower) memory measurements')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=None, help='JSON file for the results (default: print only)')
+    args = parser.parse_args()
+
+    results = run_benchmarks(tuple(args.shape), args.channels, args.cells, args.stages, args.repeat,
+                             not args.no_memory, args.workers, args.seed)
+    print(json.dumps(results['stages'], indent=2))
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Saved results to {args.out}')
+    failed = [stage for stage, stats in results['stages'].items() if 'error' in stats]
+    if failed:
+        print(f"Failed: {', '.join(failed)}")
+        sys.exit(1)
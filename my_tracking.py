@@ -26,6 +26,8 @@ from fiji.plugin.trackmate.tracking import LAPUtils
 from fiji.plugin.trackmate.providers import SpotAnalyzerProvider
 from fiji.plugin.trackmate.providers import EdgeAnalyzerProvider
 from fiji.plugin.trackmate.providers import TrackAnalyzerProvider
+from fiji.plugin.trackmate.features.track import TrackBranchingAnalyzer
+from fiji.plugin.trackmate.features.track import TrackIndexAnalyzer
 from fiji.plugin.trackmate.tracking.sparselap import SparseLAPTrackerFactory
 from fiji.plugin.trackmate.visualization.hyperstack import HyperStackDisplayer
 from fiji.plugin.trackmate.gui import TrackMateGUIController
@@ -69,11 +71,17 @@ def spots_from_results_table( results_table, frame_interval ):
 	return spots
 
 
-def create_trackmate( imp, results_table ):
+def create_trackmate( imp, results_table, all_features=False ):
 	"""
 	Creates a TrackMate instance configured to operated on the specified
 	ImagePlus imp with cell analysis stored in the specified ResultsTable
 	results_table.
+
+	By default only the track analyzers needed to filter tracks
+	(NUMBER_SPLITS) and to display them (TRACK_INDEX) are added, spot
+	positions come from the results table. With all_features, all
+	spot, edge and track features are computed (e.g. to export
+	statistics from the GUI).
 	"""
 
 	cal = imp.getCalibration()
@@ -92,32 +100,31 @@ def create_trackmate( imp, results_table ):
 	# Create the TrackMate instance.
 	trackmate = TrackMate( model, settings )
 
-	# Add ALL the feature analyzers known to TrackMate, via
-	# providers.
-	# They offer automatic analyzer detection, so all the
-	# available feature analyzers will be added.
-	# Some won't make sense on the binary image (e.g. contrast)
-	# but nevermind.
-
-	spotAnalyzerProvider = SpotAnalyzerProvider()
-	for key in spotAnalyzerProvider.getKeys():
-		print( key )
-		settings.addSpotAnalyzerFactory( spotAnalyzerProvider.getFactory( key ) )
-
-	edgeAnalyzerProvider = EdgeAnalyzerProvider()
-	for  key in edgeAnalyzerProvider.getKeys():
-		print( key )
-		settings.addEdgeAnalyzer( edgeAnalyzerProvider.getFactory( key ) )
-
-	trackAnalyzerProvider = TrackAnalyzerProvider()
-	for key in trackAnalyzerProvider.getKeys():
-		print( key )
-		settings.addTrackAnalyzer( trackAnalyzerProvider.getFactory( key ) )
+	if all_features:
+		# Add ALL the feature analyzers known to TrackMate, via
+		# providers.
+		# They offer automatic analyzer detection, so all the
+		# available feature analyzers will be added.
+		# Some won't make sense on the binary image (e.g. contrast)
+		# but nevermind.
+
+		spotAnalyzerProvider = SpotAnalyzerProvider()
+		for key in spotAnalyzerProvider.getKeys():
+			settings.addSpotAnalyzerFactory( spotAnalyzerProvider.getFactory( key ) )
+
+		edgeAnalyzerProvider = EdgeAnalyzerProvider()
+		for key in edgeAnalyzerProvider.getKeys():
+			settings.addEdgeAnalyzer( edgeAnalyzerProvider.getFactory( key ) )
+
+		trackAnalyzerProvider = TrackAnalyzerProvider()
+		for key in trackAnalyzerProvider.getKeys():
+			settings.addTrackAnalyzer( trackAnalyzerProvider.getFactory( key ) )
+	else:
+		# NUMBER_SPLITS for the track filter, TRACK_INDEX for the track colors of the displayer
+		settings.addTrackAnalyzer( TrackBranchingAnalyzer() )
+		settings.addTrackAnalyzer( TrackIndexAnalyzer() )
 
 	trackmate.getModel().getLogger().log( settings.toStringFeatureAnalyzersInfo() )
-	trackmate.computeSpotFeatures( True )
-	trackmate.computeEdgeFeatures( True )
-	trackmate.computeTrackFeatures( True )
 
 	# Skip detection and get spots from results table.
 	spots = spots_from_results_table( results_table, cal.frameInterval )
@@ -175,9 +182,10 @@ def create_trackmate( imp, results_table ):
 
 
 
-def process( trackmate ):
+def process( trackmate, all_features=False ):
 	"""
 	Execute the full process BUT for the detection step.
+	Features are computed once, spot and link features only with all_features.
 	"""
 	# Check settings.
 	ok = trackmate.checkInput()
@@ -185,8 +193,9 @@ def process( trackmate ):
 	print( 'Spot initial filtering' )
 	ok = ok and trackmate.execInitialSpotFiltering()
 	# Compute spot features.
-	print( 'Computing spot features' )
-	ok = ok and trackmate.computeSpotFeatures( True )
+	if all_features:
+		print( 'Computing spot features' )
+		ok = ok and trackmate.computeSpotFeatures( True )
 	# Filter spots.
 	print( 'Filtering spots' )
 	ok = ok and trackmate.execSpotFiltering( True )
@@ -200,8 +209,9 @@ def process( trackmate ):
 	print( 'Filtering tracks' )
 	ok = ok and trackmate.execTrackFiltering( True )
 	# Compute edge features.
-	print( 'Computing link features' )
-	ok = ok and trackmate.computeEdgeFeatures( True )
+	if all_features:
+		print( 'Computing link features' )
+		ok = ok and trackmate.computeEdgeFeatures( True )
 
 	return ok
 
@@ -294,10 +304,11 @@ def exports_rois_by_track( trackmate, rm, imp, save_dir ):
 	likely to break things.
 	"""
 	model = trackmate.getModel()
+	track_model = model.getTrackModel()
 	track_colors = {}
 	track_indices = []
 	track_rois = {}
-	for i in model.getTrackModel().trackIDs( True ):
+	for i in track_model.trackIDs( True ):
 		track_indices.append( i )
 		track_rois[i] = []
 	shuffle( track_indices )
@@ -307,6 +318,12 @@ def exports_rois_by_track( trackmate, rm, imp, save_dir ):
 		color = Jet.getPaint( float(i) / ( len( track_indices) - 1 ) )
 		track_colors[ track_id ] = color
 
+	# track id of the spots in visible (filtered) tracks, looked up once per track
+	spot_tracks = {}
+	for track_id in track_indices:
+		for spot in track_model.trackSpots( track_id ):
+			spot_tracks[ spot ] = track_id
+
 	spots = model.getSpots()
 	for spot in spots.iterable( True ):
 		q = spot.getFeature( 'QUALITY' ) # Stored the ROI id.
@@ -315,8 +332,8 @@ def exports_rois_by_track( trackmate, rm, imp, save_dir ):
 		roi_name = rm.getName( roi_id )
 
 		# Get track id.
-		track_id = model.getTrackModel().trackIDOf( spot )
-		if track_id is None or track_id not in track_indices:
+		track_id = spot_tracks.get( spot )
+		if track_id is None:
 			color = Color.GRAY
 		else:
 			color = track_colors[ track_id ]
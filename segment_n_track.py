@@ -6,10 +6,11 @@
 #@ UIService ui
 #@ RoiManager rm
 
-#@ ImagePlus imp
+#@ ImagePlus (required=false) imp
 
 #@ String (label="Track Channel", choices={"Membrane", "DNA"}, style="radioButtonHorizontal") tracking_channel
 #@ File (label="Output Directory", style="directory") save_dir
+#@ File (label="Batch Input Directory (optional, all .tif files instead of the current image)", style="directory", required="false") input_dir
 
 #@ String (visibility=MESSAGE, label="<html><br/><b>Membrane StarDist Model</b></html>", value="<html><br/><hr width='100'></html>", required="false") membrane_msg
 #@ Boolean (label="Enable", value="true") stardist_membrane_enabled
@@ -27,6 +28,7 @@
 #@ Float (label="Frame to frame linking max. distance", stepSize="0.5", min="0", max="20", style="slider", value="10.0", persist="false") frame_link_dist
 #@ Float (label="Gap closing max. distance", stepSize="0.5", min="0", max="20", style="slider", value="15.0", persist="false") gap_close_dist
 #@ Float (label="Segment splitting max. distance", stepSize="0.5", min="0", max="20", style="slider", value="7.0", persist="false") seg_split_dist
+#@ Boolean (label="Compute all TrackMate features (slower, for statistics in the GUI)", value="false", persist="false") all_features
 
 
 import sys
@@ -36,14 +38,16 @@ from random import shuffle
 import os
 
 from java.awt import Color
+from java.awt import GraphicsEnvironment
 from java.io import FileWriter
+from java.lang import Throwable
 from com.google.gson import Gson
 
+from ij import IJ
 # from ij import WindowManager
-from ij.measure import ResultsTable, Measurements
+from ij.macro import Interpreter
 from ij.plugin import ChannelSplitter
 # from ij.plugin.frame import RoiManager
-from ij.plugin.filter import Analyzer
 
 from fiji.plugin.trackmate import Logger
 from fiji.plugin.trackmate import Model
@@ -57,6 +61,8 @@ from fiji.plugin.trackmate.tracking import LAPUtils
 from fiji.plugin.trackmate.providers import SpotAnalyzerProvider
 from fiji.plugin.trackmate.providers import EdgeAnalyzerProvider
 from fiji.plugin.trackmate.providers import TrackAnalyzerProvider
+from fiji.plugin.trackmate.features.track import TrackBranchingAnalyzer
+from fiji.plugin.trackmate.features.track import TrackIndexAnalyzer
 from fiji.plugin.trackmate.tracking.sparselap import SparseLAPTrackerFactory
 from fiji.plugin.trackmate.visualization.hyperstack import HyperStackDisplayer
 from fiji.plugin.trackmate.gui import TrackMateGUIController
@@ -68,49 +74,61 @@ from de.csbdresden.stardist import StarDist2D
 
 
 
-def spots_from_results_table( results_table, frame_interval ):
+def polygon_geometry( xs, ys ):
 	"""
-	Creates a spot collection from a results table in ImageJ.
-	Requires the current results table, in which the results from
-	particle analysis should be. We need at least the center
-	of mass, the area and the slice to be specified there.
-	We also query the frame interval to properly generate the
-	POSITION_T spot feature.
+	Area and centroid (x, y) of the polygon with vertices xs, ys,
+	in pixels (shoelace formula).
 	"""
+	n = len( xs )
+	a = cx = cy = 0.
+	for i in range( n ):
+		x0, y0, x1, y1 = xs[ i ], ys[ i ], xs[ (i+1) % n ], ys[ (i+1) % n ]
+		cross = x0 * y1 - x1 * y0
+		a += cross
+		cx += ( x0 + x1 ) * cross
+		cy += ( y0 + y1 ) * cross
+	if a == 0:
+		# degenerate polygon: mean of the vertices
+		return 0., sum( xs ) / float( n ), sum( ys ) / float( n )
+	return abs( a ) / 2., cx / ( 3. * a ), cy / ( 3. * a )
+
+
+def spots_from_polygons( geometry, cal ):
+	"""
+	Creates a spot collection from the (frame, area, x, y) of each ROI
+	in the ROI Manager, as returned by export_rois. Positions and radii
+	are scaled by the calibration cal of the image, frame times by its
+	frame interval (POSITION_T spot feature).
 
-	# hyperstack
-	frames = results_table.getColumnAsDoubles( results_table.getColumnIndex( 'Frame' ) )
-	# stack
-	if frames is None:
-		frames = results_table.getColumnAsDoubles( results_table.getColumnIndex( 'Slice' ) )
+	Spots are at the centroids of the polygons instead of the (intensity
+	weighted) centers of mass that ImageJ's Measure would give.
+	"""
 
-	xs = results_table.getColumnAsDoubles( results_table.getColumnIndex( 'XM' ) )
-	ys = results_table.getColumnAsDoubles( results_table.getColumnIndex( 'YM' ) )
 	z = 0.
-	# Get radiuses from area.
-	areas = results_table.getColumnAsDoubles( results_table.getColumnIndex( 'Area' ) )
 	spots = SpotCollection()
 
-	for i in range( len( xs ) ):
-		x = xs[ i ]
-		y = ys[ i ]
-		frame = frames[ i ]
-		area = areas[ i ]
-		t = ( frame - 1 ) * frame_interval
-		radius = sqrt( area / pi )
-		quality = i # Store the line index, to later retrieve the ROI.
-		spot = Spot( x, y, z, radius, quality )
+	for i, (frame, area, x, y) in enumerate( geometry ):
+		t = ( frame - 1 ) * cal.frameInterval
+		# Get radius from area.
+		radius = sqrt( area * cal.pixelWidth * cal.pixelHeight / pi )
+		quality = i # Store the ROI index, to later retrieve the ROI.
+		spot = Spot( x * cal.pixelWidth, y * cal.pixelHeight, z, radius, quality )
 		spot.putFeature( 'POSITION_T', t )
 		spots.add( spot, int( frame - 1 ) )
 
 	return spots
 
 
-def create_trackmate( imp, results_table, frame_link_dist, gap_close_dist, seg_split_dist ):
+def create_trackmate( imp, spots, frame_link_dist, gap_close_dist, seg_split_dist, all_features=False ):
 	"""
 	Creates a TrackMate instance configured to operated on the specified
-	ImagePlus imp with cell analysis stored in the specified ResultsTable
-	results_table.
+	ImagePlus imp with the SpotCollection spots (see spots_from_polygons).
+
+	By default only the track analyzers needed to filter tracks
+	(NUMBER_SPLITS) and to display them (TRACK_INDEX) are added, spot
+	positions come from the polygons. With all_features, all
+	spot, edge and track features are computed (e.g. to export
+	statistics from the GUI).
 	"""
 
 	cal = imp.getCalibration()
@@ -129,35 +147,33 @@ def create_trackmate( imp, results_table, frame_link_dist, gap_close_dist, seg_s
 	# Create the TrackMate instance.
 	trackmate = TrackMate( model, settings )
 
-	# Add ALL the feature analyzers known to TrackMate, via
-	# providers.
-	# They offer automatic analyzer detection, so all the
-	# available feature analyzers will be added.
-	# Some won't make sense on the binary image (e.g. contrast)
-	# but nevermind.
-
-	spotAnalyzerProvider = SpotAnalyzerProvider()
-	for key in spotAnalyzerProvider.getKeys():
-		print( key )
-		settings.addSpotAnalyzerFactory( spotAnalyzerProvider.getFactory( key ) )
-
-	edgeAnalyzerProvider = EdgeAnalyzerProvider()
-	for  key in edgeAnalyzerProvider.getKeys():
-		print( key )
-		settings.addEdgeAnalyzer( edgeAnalyzerProvider.getFactory( key ) )
-
-	trackAnalyzerProvider = TrackAnalyzerProvider()
-	for key in trackAnalyzerProvider.getKeys():
-		print( key )
-		settings.addTrackAnalyzer( trackAnalyzerProvider.getFactory( key ) )
+	if all_features:
+		# Add ALL the feature analyzers known to TrackMate, via
+		# providers.
+		# They offer automatic analyzer detection, so all the
+		# available feature analyzers will be added.
+		# Some won't make sense on the binary image (e.g. contrast)
+		# but nevermind.
+
+		spotAnalyzerProvider = SpotAnalyzerProvider()
+		for key in spotAnalyzerProvider.getKeys():
+			settings.addSpotAnalyzerFactory( spotAnalyzerProvider.getFactory( key ) )
+
+		edgeAnalyzerProvider = EdgeAnalyzerProvider()
+		for key in edgeAnalyzerProvider.getKeys():
+			settings.addEdgeAnalyzer( edgeAnalyzerProvider.getFactory( key ) )
+
+		trackAnalyzerProvider = TrackAnalyzerProvider()
+		for key in trackAnalyzerProvider.getKeys():
+			settings.addTrackAnalyzer( trackAnalyzerProvider.getFactory( key ) )
+	else:
+		# NUMBER_SPLITS for the track filter, TRACK_INDEX for the track colors of the displayer
+		settings.addTrackAnalyzer( TrackBranchingAnalyzer() )
+		settings.addTrackAnalyzer( TrackIndexAnalyzer() )
 
 	trackmate.getModel().getLogger().log( settings.toStringFeatureAnalyzersInfo() )
-	trackmate.computeSpotFeatures( True )
-	trackmate.computeEdgeFeatures( True )
-	trackmate.computeTrackFeatures( True )
 
-	# Skip detection and get spots from results table.
-	spots = spots_from_results_table( results_table, cal.frameInterval )
+	# Skip detection and use the spots of the StarDist polygons.
 	model.setSpots( spots, False )
 
 	# Configure detector. We put nothing here, since we already have the spots
@@ -211,9 +227,10 @@ def create_trackmate( imp, results_table, frame_link_dist, gap_close_dist, seg_s
 	return trackmate
 
 
-def process( trackmate ):
+def process( trackmate, all_features=False ):
 	"""
 	Execute the full process BUT for the detection step.
+	Features are computed once, spot and link features only with all_features.
 	"""
 	# Check settings.
 	ok = trackmate.checkInput()
@@ -221,8 +238,9 @@ def process( trackmate ):
 	print( 'Spot initial filtering' )
 	ok = ok and trackmate.execInitialSpotFiltering()
 	# Compute spot features.
-	print( 'Computing spot features' )
-	ok = ok and trackmate.computeSpotFeatures( True )
+	if all_features:
+		print( 'Computing spot features' )
+		ok = ok and trackmate.computeSpotFeatures( True )
 	# Filter spots.
 	print( 'Filtering spots' )
 	ok = ok and trackmate.execSpotFiltering( True )
@@ -236,8 +254,9 @@ def process( trackmate ):
 	print( 'Filtering tracks' )
 	ok = ok and trackmate.execTrackFiltering( True )
 	# Compute edge features.
-	print( 'Computing link features' )
-	ok = ok and trackmate.computeEdgeFeatures( True )
+	if all_features:
+		print( 'Computing link features' )
+		ok = ok and trackmate.computeEdgeFeatures( True )
 
 	return ok
 
@@ -276,24 +295,27 @@ def color_and_export_rois_by_track( trackmate, rm, path ):
 	determined by the track ID they have.
 
 	We retrieve the IJ ROI that matches the TrackMate Spot because in the
-	latter we stored the index of the spot in the quality feature. This
-	is a hack of course. On top of that, it supposes that the index of the
-	ROI in the ROIManager corresponds to the line in the ResultsTable it
-	generated. So any changes to the ROIManager or the ResultsTable is
-	likely to break things.
+	latter we stored the index of the ROI in the ROIManager in the quality
+	feature. This is a hack of course. So any changes to the ROIManager
+	are likely to break things.
 	"""
 	model = trackmate.getModel()
+	track_model = model.getTrackModel()
 	track_colors = {}
-	track_indices = []
+	track_indices = list( track_model.trackIDs( True ) )
 	track_rois = {}
-	for i in model.getTrackModel().trackIDs( True ):
-		track_indices.append( i )
 	shuffle( track_indices )
 
 	for i, track_id in enumerate(track_indices):
 		color = Jet.getPaint( float(i) / max(1, len(track_indices)-1) )
 		track_colors[ track_id ] = color
 
+	# track id of the spots in visible (filtered) tracks, looked up once per track
+	spot_tracks = {}
+	for track_id in track_indices:
+		for spot in track_model.trackSpots( track_id ):
+			spot_tracks[ spot ] = track_id
+
 	spots = model.getSpots()
 	for spot in spots.iterable( True ):
 		q = spot.getFeature( 'QUALITY' ) # Stored the ROI id.
@@ -301,8 +323,8 @@ def color_and_export_rois_by_track( trackmate, rm, path ):
 		roi = rm.getRoi( roi_id )
 
 		# Get track id.
-		track_id = model.getTrackModel().trackIDOf( spot )
-		if track_id is None or track_id not in track_indices:
+		track_id = spot_tracks.get( spot )
+		if track_id is None:
 			color = Color.GRAY
 		else:
 			color = track_colors[ track_id ]
@@ -334,16 +356,20 @@ def rename_rois(rm, is_hyperstack):
 
 
 def export_rois(rm, is_hyperstack, path):
+	# save the polygons as json, returns (frame, area, x, y) of each ROI (see spots_from_polygons)
 	frame = (lambda roi: roi.getTPosition()) if is_hyperstack else (lambda roi: roi.getPosition())
 	rois = rm.getRoisAsArray()
 	polys = {}
+	geometry = []
 	for roi in rois:
 		fp = roi.getFloatPolygon()
 		polys[roi.getName()] = {'t': frame(roi), 'x': fp.xpoints, 'y': fp.ypoints}
+		geometry.append((frame(roi),) + polygon_geometry(fp.xpoints[:fp.npoints], fp.ypoints[:fp.npoints]))
 
 	writer = FileWriter(path)
 	Gson().toJson(polys, writer)
 	writer.close() # important
+	return geometry
 
 
 def export_calibration(imp, path):
@@ -363,40 +389,25 @@ def save_path(save_dir, imp_name, name):
 	return os.path.join(out_dir, name)
 
 
-def main():
-
-	#------------------------------
-	# 			MAIN
-	#------------------------------
+def segment_n_track(imp, models, channel_names, prob_threshs, nms_threshs, gui=True):
+	"""
+	Runs StarDist on each channel of imp and TrackMate on the polygons
+	of the tracking channel, saves everything to save_dir/<image name>/.
+	Returns an error message, or None.
+	"""
 
 	imp_name = imp.getTitle()
 	imp_name, ext = os.path.splitext(imp_name)
 
-	models, channel_names, prob_threshs, nms_threshs = [], [], [], []
-	if stardist_membrane_enabled:
-		models.append(stardist_membrane)
-		channel_names.append('Membrane')
-		prob_threshs.append(prob_thresh_membrane)
-		nms_threshs.append(nms_thresh_membrane)
-	if stardist_dna_enabled:
-		models.append(stardist_dna)
-		channel_names.append('DNA')
-		prob_threshs.append(prob_thresh_dna)
-		nms_threshs.append(nms_thresh_dna)
-
-	if len(models) == 0:
-		return error("no stardist model enabled")
-
-	if tracking_channel not in channel_names:
-		return error("channel %s cannot be tracked, must be one of %s" % (tracking_channel, channel_names))
-
 	n_channels = imp.getNChannels()
 	n_frames = imp.getNFrames()
 	is_hyperstack = n_channels > 1
 	if n_frames < 2:
-		return error("input must be a timelapse")
+		return "input must be a timelapse"
 	if n_channels != len(models):
-		return error("input image has %d channels, but %d stardist model(s) enabled" % (n_channels, len(models)))
+		return "input image has %d channels, but %d stardist model(s) enabled" % (n_channels, len(models))
+	if tracking_channel not in channel_names:
+		return "channel %s cannot be tracked, must be one of %s" % (tracking_channel, channel_names)
 
 	export_calibration( imp, save_path(save_dir, imp_name, 'calibration.json') )
 
@@ -415,6 +426,7 @@ def main():
 
 
 	print "\n===============================\n"
+	print imp_name
 	for channel_name, channel, model, prob_thresh, nms_thresh in args:
 		params['input'] = channel
 		params['modelFile'] = model.getAbsolutePath()
@@ -422,44 +434,28 @@ def main():
 		params['nmsThresh'] = nms_thresh
 
 		# print 'StarDist', channel_name, ':', params, '\n'
+		rm.reset()
 		command.run(StarDist2D, False, params).get()
 		rename_rois( rm, is_hyperstack )
 		rm.runCommand( "Save",          save_path(save_dir, imp_name, 'rois_%s.zip'  % channel_name.lower()) )
-		export_rois( rm, is_hyperstack, save_path(save_dir, imp_name, 'rois_%s.json' % channel_name.lower()) )
-
-	assert channel_name == tracking_channel
-
-	# backup global user-chosen measurements
-	measurements = Analyzer.getMeasurements()
-	# set needed measurements
-	Analyzer.setMeasurements(Measurements.AREA + Measurements.CENTER_OF_MASS + Measurements.STACK_POSITION)
-	# create measurements table
-	rm.runCommand(imp, "Measure");
-	# restore global user-chosen measurements
-	Analyzer.setMeasurements(measurements)
-
-	# close/hide measurements table
-	results_window = ResultsTable.getResultsWindow()
-	results_window.close(False)
-	# results_window.setVisible(False)
+		geometry = export_rois( rm, is_hyperstack, save_path(save_dir, imp_name, 'rois_%s.json' % channel_name.lower()) )
 
 	# Remove overlay if any.
 	imp.setOverlay( None )
 
-	# Get results table.
-	results_table = ResultsTable.getResultsTable()
-	# print results_table
+	# Spots from the polygons of the tracking channel, no need to measure the ROIs.
+	spots = spots_from_polygons( geometry, imp.getCalibration() )
 
 	# Create TrackMate instance.
-	trackmate = create_trackmate( imp, results_table, frame_link_dist, gap_close_dist, seg_split_dist )
+	trackmate = create_trackmate( imp, spots, frame_link_dist, gap_close_dist, seg_split_dist, all_features )
 
 	#-----------------------
 	# Process.
 	#-----------------------
 
-	ok = process( trackmate )
+	ok = process( trackmate, all_features )
 	if not ok:
-		sys.exit(str(trackmate.getErrorMessage()))
+		return str(trackmate.getErrorMessage())
 
 	#-----------------------
 	# Display results.
@@ -468,9 +464,71 @@ def main():
 	# TODO: close trackmate gui?
 
 	# Create the GUI and let it control display of results.
-	display_results_in_GUI( trackmate, imp )
+	if gui:
+		display_results_in_GUI( trackmate, imp )
 
 	color_and_export_rois_by_track( trackmate, rm, save_path(save_dir, imp_name, 'tracks_%s.csv' % tracking_channel.lower()) )
 
 
+def main():
+
+	#------------------------------
+	# 			MAIN
+	#------------------------------
+
+	models, channel_names, prob_threshs, nms_threshs = [], [], [], []
+	if stardist_membrane_enabled:
+		models.append(stardist_membrane)
+		channel_names.append('Membrane')
+		prob_threshs.append(prob_thresh_membrane)
+		nms_threshs.append(nms_thresh_membrane)
+	if stardist_dna_enabled:
+		models.append(stardist_dna)
+		channel_names.append('DNA')
+		prob_threshs.append(prob_thresh_dna)
+		nms_threshs.append(nms_thresh_dna)
+
+	if len(models) == 0:
+		return error("no stardist model enabled")
+
+	if tracking_channel not in channel_names:
+		return error("channel %s cannot be tracked, must be one of %s" % (tracking_channel, channel_names))
+
+	if input_dir is None:
+		if imp is None:
+			return error("no image open and no batch input directory chosen")
+		msg = segment_n_track( imp, models, channel_names, prob_threshs, nms_threshs, gui=not GraphicsEnvironment.isHeadless() )
+		if msg is not None:
+			return error(msg)
+		return
+
+	# Batch mode: all images of input_dir in this Fiji session, without windows or TrackMate GUI
+	names = sorted(f for f in os.listdir(input_dir.getAbsolutePath()) if f.lower().endswith(('.tif', '.tiff')))
+	batch_mode = Interpreter.batchMode
+	Interpreter.batchMode = True
+	failed = []
+	try:
+		for k, name in enumerate(names):
+			print "\n[%d/%d] %s" % (k+1, len(names), name)
+			_imp = None
+			try:
+				_imp = IJ.openImage(os.path.join(input_dir.getAbsolutePath(), name))
+				msg = "cannot open image" if _imp is None else segment_n_track( _imp, models, channel_names, prob_threshs, nms_threshs, gui=False )
+			except (Exception, Throwable) as e:
+				# e.g. from StarDist or TrackMate, continue with the next image
+				msg = "%s: %s" % (type(e).__name__, e)
+			finally:
+				if _imp is not None:
+					_imp.close()
+				rm.reset()
+			if msg is not None:
+				print "Skipping %s: %s" % (name, msg)
+				failed.append(name)
+	finally:
+		Interpreter.batchMode = batch_mode
+	print "\nProcessed %d/%d images from %s" % (len(names)-len(failed), len(names), input_dir)
+	if failed:
+		print "Failed: %s" % ', '.join(failed)
+
+
 main()
\ No newline at end of file
@@ -1,22 +1,39 @@
+import os
+import re
+import sys
+import json
+import time
+import mmap
+import tempfile
+import queue
+import hashlib
+import struct
+import zipfile
+import zlib
+import threading
+import traceback
+import multiprocessing
 import numpy as np
-from collections import namedtuple
-from csbdeep.utils import _raise, load_json, save_json, move_image_axes, normalize
+from collections import namedtuple, deque
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor, as_completed, Future
+from csbdeep.utils import _raise, load_json, save_json, move_image_axes
 from pathlib import Path
 
+import tifffile
 from tifffile import imread, TiffFile
 from csbdeep.io import save_tiff_imagej_compatible
-import imreg_dft as ird
+from skimage.registration import phase_cross_correlation
+from skimage.draw import polygon as draw_polygon
+from skimage.measure import regionprops
+from scipy.spatial import cKDTree
 
-import keras.backend as K
-from stardist import export_imagej_rois
-from stardist.models import StarDist2D
+# tensorflow/keras, stardist and imreg_dft are imported where needed, so that
+# post-processing and the command line (python -m starchaea) start quickly
 
-try:
-    from tqdm.notebook import tqdm as tqdm_notebook
-except ModuleNotFoundError:
-    from tqdm import tqdm_notebook
-# from tqdm import tqdm
-tqdm = tqdm_notebook
+# notebook progress bars in Jupyter, plain ones in a terminal
+from tqdm.auto import tqdm
+tqdm_notebook = tqdm
 
 
 
@@ -44,6 +61,34 @@ _config = namedtuple('Config',(
     'export_xlsx_file',
     'frame_interval_seconds',
     'pixel_size_um',
+
+    'predict_batch_size',
+    'drift_correction_backend',
+    'drift_correction_downsample',
+    'drift_correction_workers',
+    'lazy_loading',
+    'manifest_dir',
+    'tracks_dir',
+    'profile_file',
+    'trace_file',
+    'model_server',
+    'predict_memory_mb',
+    'prediction_cache_dir',
+    'prediction_cache_mb',
+), defaults=(
+    1,     # predict_batch_size
+    'ird', # drift_correction_backend
+    1,     # drift_correction_downsample
+    None,  # drift_correction_workers
+    False, # lazy_loading
+    'manifest', # manifest_dir, None -> always recompute
+    None,  # tracks_dir, None -> track with Fiji/TrackMate instead
+    None,  # profile_file, JSON lines with the time and memory of each stage, None -> no profiling
+    None,  # trace_file, Chrome trace of profile_file written by run_all
+    None,  # model_server, address ('host:port' or socket path) of a ModelServer, None -> load models in this process
+    None,  # predict_memory_mb, memory budget of prediction to choose tiles/blocks, None -> whole frames
+    None,  # prediction_cache_dir, cache of network outputs (float16) to rerun only NMS for new thresholds, None -> no cache
+    20000, # prediction_cache_mb
 ));
 
 
@@ -59,17 +104,1734 @@ class Config(_config):
 
 
 
+def _percentiles_from_histogram(x, pmin, pmax):
+    # np.percentile (linear interpolation) of every image x[i] for integer data,
+    # computed in O(n) from a per-image histogram instead of sorting
+    x = x.reshape(len(x),-1)
+    n = x.shape[1]
+    offset = int(x.min())
+    nbins = int(x.max()) - offset + 1
+    cdf = np.empty((len(x),nbins), np.int64)
+    for h, _x in zip(cdf, x):
+        h[:] = np.bincount(_x if offset == 0 else (_x.astype(np.int64) - offset), minlength=nbins)
+    np.cumsum(cdf, axis=1, out=cdf)
+
+    def _value(k):
+        # k-th smallest value of each image
+        return ((cdf <= k).sum(axis=1) + offset).astype(np.float64)
+
+    res = []
+    for p in (pmin,pmax):
+        virtual_index = (p/100) * (n-1)
+        k = np.floor(virtual_index)
+        gamma = virtual_index - k
+        a, b = _value(k), _value(min(k+1,n-1))
+        # same interpolation as numpy's _lerp
+        res.append(b - (b-a)*(1-gamma) if gamma >= 0.5 else a + (b-a)*gamma)
+    return res
+
+
+def _chunk_percentiles(x, pmin, pmax):
+    # percentiles of every image (last two axes) of the in-memory array x, shape x.shape[:-2]+(1,1)
+    shape = x.shape[:-2]+(1,1)
+    if np.issubdtype(x.dtype, np.integer) and x.dtype.itemsize <= 2:
+        mi, ma = _percentiles_from_histogram(x.reshape((-1,)+x.shape[-2:]), pmin, pmax)
+        return mi.reshape(shape), ma.reshape(shape)
+    else:
+        return (np.percentile(x, pmin, axis=(-2,-1), keepdims=True),
+                np.percentile(x, pmax, axis=(-2,-1), keepdims=True))
+
+
+def _normalize_mi_ma(x, mi, ma, clip, eps):
+    # in-place version of csbdeep.utils.normalize_mi_ma for float32 x
+    mi, ma = np.asarray(mi, np.float32), np.asarray(ma, np.float32)
+    np.subtract(x, mi, out=x)
+    np.divide(x, ma - mi + np.float32(eps), out=x)
+    if clip:
+        np.clip(x, 0, 1, out=x)
+    return x
+
+
+def timelapse_percentiles(x, pmin=3, pmax=99.8, chunk_size=16):
+    """Percentiles pmin and pmax of every 2D image (last two axes) of x, each of shape x.shape[:-2]+(1,1).
+
+    x is read chunk_size frames at a time, hence can also be a lazy (e.g. memory-mapped) array.
+    """
+    x.ndim >= 3 or _raise(ValueError('need at least 3 dimensions'))
+    mi = np.empty(x.shape[:-2]+(1,1))
+    ma = np.empty(x.shape[:-2]+(1,1))
+    for i in range(0, len(x), chunk_size):
+        mi[i:i+chunk_size], ma[i:i+chunk_size] = _chunk_percentiles(np.asarray(x[i:i+chunk_size]), pmin, pmax)
+    return mi, ma
+
+
+def normalize_timelapse(x, pmin=3, pmax=99.8, clip=False, eps=1e-20, out=None, chunk_size=16):
+    """Percentile-based normalization of every 2D image (last two axes) of x.
+
+    Equivalent to np.stack([csbdeep.utils.normalize(img, pmin, pmax, clip=clip) for img in x]),
+    but writes float32 into a single output buffer (allocated if out is None),
+    processing chunk_size frames at a time (all at once if None).
+
+    For integer data up to 16 bit, the percentiles are obtained from per-image histograms
+    and agree with np.percentile up to float64 rounding; the normalized values then agree with
+    csbdeep's normalize to within 1e-6 (relative). Other data falls back to np.percentile.
+    """
+    x.ndim >= 3 or _raise(ValueError('need at least 3 dimensions'))
+    if out is None:
+        out = np.empty(x.shape, np.float32)
+    out.shape == x.shape and out.dtype == np.float32 or _raise(ValueError('output must be float32 and of same shape as input'))
+
+    if chunk_size is None:
+        chunk_size = max(1,len(x))
+    for i in range(0, len(x), chunk_size):
+        _x, _o = np.asarray(x[i:i+chunk_size]), out[i:i+chunk_size]
+        mi, ma = _chunk_percentiles(_x, pmin, pmax)
+        _o[:] = _x
+        _normalize_mi_ma(_o, mi, ma, clip, eps)
+
+    return out
+
+
+class NormalizedView:
+    """Lazily percentile-normalized view of x (see normalize_timelapse), evaluated when indexed.
+
+    Only the per-image percentiles are computed upfront, e.g. to cut out normalized
+    crops of a memory-mapped timelapse without ever holding all of it in memory.
+    """
+
+    def __init__(self, x, pmin=3, pmax=99.8, clip=False, eps=1e-20, chunk_size=16, percentiles=None):
+        self.x = x
+        self.clip, self.eps = clip, eps
+        # percentiles: (mi, ma) as returned by timelapse_percentiles, if already known
+        self.mi, self.ma = timelapse_percentiles(x, pmin, pmax, chunk_size) if percentiles is None else percentiles
+
+    @property
+    def shape(self):
+        return self.x.shape
+
+    @property
+    def ndim(self):
+        return self.x.ndim
+
+    dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, key):
+        x = np.array(self.x[key], np.float32)
+        mi = np.broadcast_to(self.mi, self.shape)[key]
+        ma = np.broadcast_to(self.ma, self.shape)[key]
+        return _normalize_mi_ma(x, mi, ma, self.clip, self.eps)
+
+    def __array__(self, dtype=None, copy=None):
+        return self[...] if dtype is None else self[...].astype(dtype)
+
+
+class _WithChannelAxis:
+    # TYX array (e.g. zarr) presented as TCYX with a singleton channel axis, read on indexing
+
+    def __init__(self, x):
+        x.ndim == 3 or _raise(ValueError())
+        self.x = x
+        self.shape = (x.shape[0],1) + tuple(x.shape[1:])
+        self.ndim = 4
+        self.dtype = np.dtype(x.dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        if any(k is Ellipsis for k in key):
+            i = [k is Ellipsis for k in key].index(True)
+            key = key[:i] + (slice(None),)*(self.ndim-len(key)+1) + key[i+1:]
+        key = key + (slice(None),)*(self.ndim-len(key))
+        x = np.asarray(self.x[(key[0],)+key[2:]])
+        pos = 0 if isinstance(key[0], (int,np.integer)) else 1
+        x = np.expand_dims(x, pos)
+        return x[(slice(None),)*pos + (key[1],)]
+
+    def __array__(self, dtype=None, copy=None):
+        return self[...] if dtype is None else self[...].astype(dtype)
+
+
+def _lazy_tcyx(x):
+    if x.ndim == 3:
+        return x[:,np.newaxis] if isinstance(x, np.ndarray) else _WithChannelAxis(x)
+    return x
+
+
+def imread_lazy(file):
+    """Read-only, lazily loaded image data of a TIFF file.
+
+    Returns a numpy.memmap if the image data is stored uncompressed and contiguously,
+    otherwise a zarr array backed by tifffile's zarr store (requires zarr).
+    """
+    try:
+        return tifffile.memmap(str(file), mode='r')
+    except ValueError:
+        try:
+            import zarr
+        except ModuleNotFoundError:
+            raise ModuleNotFoundError(f"{file} cannot be memory-mapped, reading it lazily requires 'zarr'")
+        return zarr.open(imread(str(file), aszarr=True), mode='r')
+
+
+def _imagej_dtype(dtype):
+    # data type that csbdeep's save_tiff_imagej_compatible would save
+    t = np.dtype(dtype)
+    if   'float' in t.name: return np.dtype(np.float32)
+    elif 'uint'  in t.name: return np.dtype(np.uint16 if t.itemsize >= 2 else np.uint8)
+    elif 'int'   in t.name: return np.dtype(np.int16)
+    else:                   return t
+
+
+class TiffStreamWriter:
+    """Write a TCYX timelapse frame by frame to an ImageJ-compatible TIFF.
+
+    The file is byte-identical to save_tiff_imagej_compatible(file, timelapse, axes='TCYX'),
+    but only the frames that are in flight to the (background) writer are kept in memory.
+    All frames must be appended, otherwise close() raises an error.
+    """
+
+    def __init__(self, file, shape, dtype):
+        len(shape) == 4 or _raise(ValueError('shape must be TCYX'))
+        self.file = Path(file)
+        self.dtype = _imagej_dtype(dtype)
+        self._queue = queue.Queue(maxsize=2)
+        self._error = None
+        self._thread = threading.Thread(target=self._write, args=((shape[0],1)+tuple(shape[1:]),), daemon=True)
+        self._thread.start()
+
+    def _frames(self):
+        while True:
+            frame = self._queue.get()
+            if frame is None:
+                return
+            if frame is Ellipsis:
+                raise RuntimeError('writing aborted')
+            yield frame
+
+    def _write(self, shape):
+        try:
+            with tifffile.TiffWriter(str(self.file), imagej=True) as tif:
+                tif.write(self._frames(), shape=shape, dtype=self.dtype, metadata={'axes':'TZCYX'})
+        except BaseException as e:
+            self._error = e
+
+    def _put(self, item):
+        while True:
+            try:
+                return self._queue.put(item, timeout=1)
+            except queue.Full:
+                if not self._thread.is_alive():
+                    break
+        raise RuntimeError(f'writing to {self.file} failed') from self._error
+
+    def append(self, frame):
+        self._put(np.asarray(frame).astype(self.dtype, copy=False))
+
+    def close(self, abort=False):
+        if self._thread.is_alive():
+            self._put(Ellipsis if abort else None)
+            self._thread.join()
+        if abort:
+            self.file.unlink(missing_ok=True)
+        elif self._error is not None:
+            raise RuntimeError(f'writing to {self.file} failed') from self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(abort=exc_type is not None)
+
+
+def _downsample(x, factor):
+    # block-average the last two axes by an integer factor
+    if factor == 1:
+        return x.astype(np.float32)
+    h, w = (s//factor*factor for s in x.shape[-2:])
+    x = x[...,:h,:w].reshape(x.shape[:-2]+(h//factor,factor,w//factor,factor))
+    return x.mean(axis=(-3,-1), dtype=np.float32)
+
+
+def _pairwise_shifts(frames, upsample_factor):
+    # shifts that register frames[i+1] onto frames[i]
+    return np.array([phase_cross_correlation(a, b, upsample_factor=upsample_factor, normalization='phase')[0]
+                     for a, b in zip(frames[:-1], frames[1:])]).reshape(-1,2)
+
+
+def _apodize(x):
+    # otherwise the image borders bias the phase correlation peak towards zero shift
+    x -= x.mean(axis=(-2,-1), keepdims=True)
+    x *= np.outer(np.hanning(x.shape[-2]), np.hanning(x.shape[-1])).astype(np.float32)
+    return x
+
+
+# cores this process may use, set in the worker processes of Starchaea.run_all (None -> all)
+_cpu_budget = None
+
+def _available_cpus():
+    return _cpu_budget or os.cpu_count() or 1
+
+
+def estimate_drift(frames, downsample=1, upsample_factor=10, workers=None, channel=None):
+    """Absolute translation (TY,TX) for each frame of a TYX timelapse that registers it onto the first frame.
+
+    Shifts between consecutive raw frames are estimated with FFT phase correlation
+    (on apodized frames block-averaged by 'downsample', with subpixel refinement by 'upsample_factor')
+    in a pool of 'workers' processes (default: the cores available to this process), and then accumulated.
+    If 'channel' is given, frames is a TCYX timelapse and only that channel is used.
+    Frames are read in blocks, hence can also be a lazy (e.g. memory-mapped) array.
+    """
+    n = frames.shape[0]
+    if workers is None:
+        workers = _available_cpus()
+    # consecutive, overlapping blocks of frames such that every pair is in exactly one block
+    n_blocks = max(1, min(n-1, 4*workers))
+    bounds = np.linspace(0, n-1, n_blocks+1).round().astype(int)
+    blocks = [(a,b) for a,b in zip(bounds[:-1],bounds[1:]) if b > a]
+
+    def _read(a, b):
+        x = frames[a:b+1] if channel is None else frames[a:b+1,channel]
+        return _apodize(_downsample(np.asarray(x), downsample))
+
+    if workers > 1 and len(blocks) > 1:
+        pairwise, pending = [], deque()
+        # spawn: forking after tensorflow models were loaded is unsafe
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            for a,b in blocks:
+                pending.append(pool.submit(_pairwise_shifts, _read(a,b), upsample_factor))
+                # bound the number of blocks held in memory
+                if len(pending) >= 2*workers:
+                    pairwise.append(pending.popleft().result())
+            pairwise.extend(f.result() for f in pending)
+    else:
+        pairwise = [_pairwise_shifts(_read(a,b), upsample_factor) for a,b in blocks]
+
+    shifts = np.zeros((n,2), np.float64)
+    if n > 1:
+        shifts[1:] = np.cumsum(np.concatenate(pairwise), axis=0) * downsample
+    return shifts
+
+
+def _border_value(x, radius=None):
+    # median of the border pixels of each image (as in imreg_dft.utils.get_borderval)
+    if radius is None:
+        radius = max(1, min(x.shape[-2:]) // 20)
+    mask = np.zeros(x.shape[-2:], bool)
+    mask[:,:radius] = mask[:,-radius:] = mask[:radius] = mask[-radius:] = True
+    return np.median(x[...,mask], axis=-1)
+
+
+def _shift_axis(x, shifts, axis, cval):
+    # linear interpolation of x[i] shifted by shifts[i] along axis (out[k] = in[k-shift]),
+    # with constant value cval outside
+    n = x.shape[axis]
+    base = np.floor(-shifts).astype(int)
+    frac = (-shifts - base).astype(np.float32)
+    shape = [1]*x.ndim
+    shape[0], shape[axis] = len(x), n
+    expand = lambda v: v.reshape((len(x),)+(1,)*(x.ndim-1))
+    out = None
+    for offset, weight in ((0, 1-frac), (1, frac)):
+        ind = np.arange(n)[np.newaxis] + (base + offset)[:,np.newaxis]
+        valid = ((ind >= 0) & (ind < n)).reshape(shape)
+        g = np.take_along_axis(x, np.clip(ind, 0, n-1).reshape(shape), axis=axis)
+        g = np.where(valid, g, cval)
+        g *= expand(weight)
+        out = g if out is None else np.add(out, g, out=out)
+    return out
+
+
+def shift_frames(x, shifts, out=None, chunk_size=16):
+    """Translate each frame x[t] (shape TYX or TCYX) by shifts[t] = (TY,TX) with linear interpolation.
+
+    All channels of all frames in a chunk are shifted in one vectorized operation;
+    areas shifted in from outside are filled with each image's border value.
+    Frames are read and written in chunks, hence x and out can also be lazy (e.g. memory-mapped) arrays.
+    """
+    shifts = np.asarray(shifts, np.float64)
+    len(shifts) == len(x) and shifts.shape[1:] == (2,) or _raise(ValueError('need one (TY,TX) shift per frame'))
+    if out is None:
+        out = np.empty(x.shape, np.float32)
+    for i in range(0, len(x), chunk_size):
+        _x = np.asarray(x[i:i+chunk_size]).astype(np.float32)
+        s = shifts[i:i+chunk_size]
+        cval = _border_value(_x)[...,np.newaxis,np.newaxis].astype(np.float32)
+        _x = _shift_axis(_x, s[:,0], _x.ndim-2, cval)
+        _x = _shift_axis(_x, s[:,1], _x.ndim-1, cval)
+        out[i:i+chunk_size] = _x
+    return out
+
+
+def predict_instances_batch(model, frames, prob_thresh=None, nms_thresh=None):
+    # same result as [model.predict_instances(x, prob_thresh=.., nms_thresh=..)[1] for x in frames],
+    # but with a single forward pass of the network for all (normalized, equally-sized) frames
+    # note: results are bit-identical only if the backend computes each batch item independently
+    #       of the batch size (true for TF1; for TF2 set TF_ENABLE_ONEDNN_OPTS=0)
+    if isinstance(model, RemoteModel):
+        return model.predict_instances_batch(frames, prob_thresh=prob_thresh, nms_thresh=nms_thresh)
+    if prob_thresh is None: prob_thresh = model.thresholds.prob
+    if nms_thresh  is None: nms_thresh  = model.thresholds.nms
+
+    polygons = []
+    for frame, prob, dist in zip(frames, *predict_maps(model, frames)):
+        prob, dist, points = _candidates(prob, dist, frame.shape, model.config.grid, prob_thresh)
+        polygons.append(model._instances_from_prediction(frame.shape, prob, dist, points=points,
+                                                         prob_thresh=prob_thresh, nms_thresh=nms_thresh, return_labels=False)[1])
+    return polygons
+
+
+def predict_maps(model, frames):
+    # network outputs for (normalized, equally-sized) frames in a single forward pass: probabilities (N,Y',X') and
+    # distances (N,Y',X',n_rays) on the grid, for the frames padded (at the end) to a multiple of the grid
+    from stardist.models.base import StarDistPadAndCropResizer
+    axes_net = model.config.axes
+    resizer = StarDistPadAndCropResizer(grid=dict(zip(axes_net.replace('C',''),model.config.grid)))
+    div_by = model._axes_div_by(axes_net)
+    x = np.stack([resizer.before(frame[...,np.newaxis], axes_net, div_by) for frame in frames])
+    prob, dist = model.keras_model.predict(x, batch_size=len(x), verbose=0)[:2]
+    return prob[...,0], dist
+
+
+def _candidates(prob, dist, shape, grid, prob_thresh):
+    # sparse candidate selection as in StarDist2D.predict_sparse, without points in the padding
+    from stardist.nms import _ind_prob_thresh
+    prob, dist = np.asarray(prob, np.float32), np.maximum(1e-3, np.asarray(dist, np.float32))
+    inds = _ind_prob_thresh(prob, prob_thresh, b=2)
+    points = np.stack(np.where(inds), axis=1) * np.array(grid).reshape((1,-1))
+    idx = np.flatnonzero(np.all(points < np.array(shape), axis=1))
+    return prob[inds][idx], dist[inds][idx], points[idx]
+
+
+def polygons_from_maps(prob, dist, shape, grid, prob_thresh, nms_thresh):
+    # polygons of a frame of shape (Y,X) from its network outputs (see predict_maps), as StarDist2D.predict_instances
+    # finds them, but without the model (and tensorflow)
+    from stardist.nms import non_maximum_suppression_sparse
+    from stardist.geometry import dist_to_coord
+    prob, dist, points = _candidates(prob, dist, shape, grid, prob_thresh)
+    points, prob, dist, _ = non_maximum_suppression_sparse(dist, prob, points, nms_thresh=nms_thresh)
+    return dict(coord=dist_to_coord(dist, points), points=points, prob=prob)
+
+
+
+def _prediction_bytes_per_pixel(model):
+    # rough (about 2x too high on CPU) estimate of the memory of StarDist prediction per input pixel (float32):
+    # the network (input, two full-resolution convolutions, U-Net levels on the grid), and the
+    # probability/distance maps of the whole image that are kept for NMS
+    c = model.config
+    g = np.prod(c.grid)
+    unet = sum(c.unet_n_filter_base*2**d * (c.unet_n_conv_per_depth+1) / 4**d for d in range(c.unet_n_depth+1))
+    network = 4 * (c.n_channel_in + 2*c.unet_n_filter_base + (unet + c.net_conv_after_unet) / g)
+    maps = 4 * (1 + c.n_rays) / g
+    return network, maps
+
+
+def _round_down(x, multiple):
+    return max(multiple, int(x) // multiple * multiple)
+
+
+def prediction_tiling(model, shape, memory_mb, min_overlap=64):
+    """Tiling of the StarDist prediction of frames of shape (Y,X) within a memory budget.
+
+    Uses n_tiles so that the network of a tile fits, and blocks (predict_instances_big, with
+    block_size and min_overlap) if the probability/distance maps of a frame take more than a
+    quarter of the budget. Objects must be smaller than min_overlap. Memory is estimated, not measured.
+    Returns a dict with n_tiles, block_size (None for whole frames) and the estimated memory in MB.
+    """
+    budget = memory_mb * 2**20
+    network, maps = _prediction_bytes_per_pixel(model)
+    grid = max(model.config.grid)
+    overlap = np.asarray(model._axes_tile_overlap('YX'))
+    shape = np.asarray(shape)
+
+    block_size = None
+    if np.prod(shape) * maps > budget/4:
+        # with the context discarded on both sides of a block
+        side = np.sqrt(budget/4 / maps)
+        block_size = _round_down(side - 2*overlap.max(), grid)
+        block_size > min_overlap + 2*overlap.max() or _raise(ValueError(f'memory budget of {memory_mb} MB is too small for blocks'))
+        # fewest blocks, of equal size
+        n_blocks = np.ceil((shape.max() - min_overlap) / (block_size - min_overlap))
+        block_size = min(block_size, _round_down(np.ceil((shape.max() - min_overlap) / n_blocks) + min_overlap + grid-1, grid))
+        shape = np.minimum(shape, block_size + 2*overlap)
+
+    n_tiles = np.ones(2, int)
+    tile_bytes = lambda n: network * np.prod(np.ceil(shape/n) + np.where(n > 1, 2*overlap, 0))
+    while np.prod(shape) * maps + tile_bytes(n_tiles) > budget:
+        # split the axis with the longest tiles
+        ax = np.argmax(shape / n_tiles)
+        shape[ax] / (n_tiles[ax]+1) >= overlap[ax] or _raise(ValueError(f'memory budget of {memory_mb} MB is too small for tiles'))
+        n_tiles[ax] += 1
+
+    return dict(n_tiles=tuple(int(n) for n in n_tiles), block_size=block_size, min_overlap=min_overlap,
+                memory_mb=(np.prod(shape) * maps + tile_bytes(n_tiles)) / 2**20)
+
+
+def predict_instances_tiled(model, img, tiling, prob_thresh=None, nms_thresh=None):
+    # polygons of model.predict_instances(img), with the tiling of prediction_tiling
+    if tiling['block_size'] is None:
+        return model.predict_instances(img, prob_thresh=prob_thresh, nms_thresh=nms_thresh,
+                                       n_tiles=tiling['n_tiles'], show_tile_progress=False)[1]
+    return model.predict_instances_big(img, axes='YX', block_size=tiling['block_size'], min_overlap=tiling['min_overlap'],
+                                       labels_out=False, show_progress=False, n_tiles=tiling['n_tiles'], show_tile_progress=False,
+                                       prob_thresh=prob_thresh, nms_thresh=nms_thresh)[1]
+
+
+
+def export_imagej_rois(fname, polygons, **kwargs):
+    # stardist.export_imagej_rois, imported on first use
+    from stardist import export_imagej_rois
+    return export_imagej_rois(fname, polygons, **kwargs)
+
+
+
+def _polygon_moments(coord):
+    # signed area, centroid and central second moments (normalized by area) of polygons (N,2,n_rays),
+    # from the moments of the enclosed region computed with Green's theorem
+    coord = np.asarray(coord, np.float64)
+    y, x = coord[:,0], coord[:,1]
+    y1, x1 = np.roll(y,-1,axis=1), np.roll(x,-1,axis=1)
+    cross = y*x1 - y1*x
+    area = cross.sum(axis=1) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cy = ((y+y1)*cross).sum(axis=1) / (6*area)
+        cx = ((x+x1)*cross).sum(axis=1) / (6*area)
+        syy = ((y*y+y*y1+y1*y1)*cross).sum(axis=1) / (12*area) - cy*cy
+        sxx = ((x*x+x*x1+x1*x1)*cross).sum(axis=1) / (12*area) - cx*cx
+        sxy = ((x*y1+2*x*y+2*x1*y1+x1*y)*cross).sum(axis=1) / (24*area) - cx*cy
+    return area, np.stack([cy,cx],axis=1), syy, sxx, sxy
+
+
+def polygon_area_centroid(coord):
+    # (unsigned) area and centroid of polygons with coordinates (N,2,n_rays)
+    area, centroid = _polygon_moments(coord)[:2]
+    return np.abs(area), centroid
+
+
+def polygon_shape_features(coord):
+    """Shape features of polygons (N,2,n_rays) as computed by skimage.measure.regionprops, without rasterizing.
+
+    Returns a dict with arrays centroid (N,2), area, eccentricity, major_axis_length and minor_axis_length,
+    computed from the moments of the polygons (i.e. of the continuous region, not of its pixels).
+    Compared to regionprops of masks drawn with skimage.draw.polygon, the differences are due to pixelation and
+    shrink with polygon size; for star-convex polygons with radius >= 8 pixels (tested on random ellipses):
+    area < 4%, centroid < 0.25 pixels, major/minor axis length < 3% (0.6 pixels), axis ratio (minor/major) < 0.04.
+    Eccentricity (sqrt(1 - ratio**2)) is ill-conditioned for nearly circular shapes: it differs by < 0.05 for
+    eccentricity >= 0.5, but by up to ~0.2 below (e.g. 0.03 vs. 0.19 of regionprops for a near circle).
+    """
+    area, centroid, syy, sxx, sxy = _polygon_moments(coord)
+    # eigenvalues of the covariance (inertia tensor)
+    mean, d = (syy+sxx)/2, np.sqrt(((syy-sxx)/2)**2 + sxy**2)
+    l1, l2 = mean + d, np.maximum(mean - d, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        eccentricity = np.sqrt(1 - l2/l1)
+    return dict (
+        centroid          = centroid,
+        area              = np.abs(area),
+        eccentricity      = eccentricity,
+        major_axis_length = 4*np.sqrt(l1),
+        minor_axis_length = 4*np.sqrt(l2),
+    )
+
+
+PolygonProps = namedtuple('PolygonProps', ('centroid','area','eccentricity','major_axis_length','minor_axis_length'))
+
+def polygon_shape_props(coord):
+    # polygon_shape_features as one PolygonProps per polygon (with the attribute names of regionprops)
+    features = polygon_shape_features(coord)
+    return [PolygonProps(*(features[k][i] for k in PolygonProps._fields)) for i in range(len(features['area']))]
+
+
+def rasterized_shape_features(coord, frame, shape):
+    """Shape features of polygons (N,2,n_rays) in frames frame (N,) as computed by skimage.measure.regionprops.
+
+    The polygons are drawn with rasterize_polygons into a label stack of shape (T,Y,X), i.e. the features are those
+    of their pixels. Where polygons of a frame overlap, the pixels go to the later one; features of polygons without
+    any pixels are nan. Returns the same dict as polygon_shape_features.
+    """
+    labels = rasterize_polygons(coord, frame, shape, instance_ids=True)
+    features = dict(centroid=np.full((len(coord),2), np.nan),
+                    **{k: np.full(len(coord), np.nan) for k in PolygonProps._fields[1:]})
+    for t in np.unique(frame):
+        for props in regionprops(labels[t]):
+            k = props.label - 1
+            features['centroid'][k]          = props.centroid
+            features['area'][k]              = props.area
+            features['eccentricity'][k]      = props.eccentricity
+            features['major_axis_length'][k] = props.axis_major_length
+            features['minor_axis_length'][k] = props.axis_minor_length
+    return features
+
+
+def _polygon_box(coord, shape):
+    # bounding box [lo,hi) of a polygon (2,n_points) within an image of shape (Y,X)
+    lo = np.maximum(0, np.floor(np.min(coord, axis=1))).astype(int)
+    hi = np.minimum(shape[-2:], np.ceil(np.max(coord, axis=1)) + 1).astype(int)
+    return lo, np.maximum(lo, hi)
+
+
+def polygon_mean_signal(image, coord):
+    # mean of the image inside a polygon (2,n_rays), only rasterizing the polygon's bounding box
+    lo, hi = _polygon_box(coord, image.shape)
+    rr, cc = draw_polygon(coord[0]-lo[0], coord[1]-lo[1], tuple(hi-lo))
+    return np.mean(image[lo[0]+rr, lo[1]+cc])
+
+
+def _scanline_spans(r, c, prev, poly, ny, nx, left):
+    """Pixel spans (polygon, row, start, stop) by the crossing parity of skimage's point_in_polygon.
+
+    Edges go from vertex prev[k] to vertex k of polygon poly[k]. For each row, a pixel counts the edges crossed by the
+    ray to its right (or to its left if left). Which pixels an edge counts for is decided by evaluating
+    skimage's (floating point) crossing test only at the pixels next to the intersection, since it is
+    exact up to rounding. Pixels with an odd count lie between every other pair of sorted thresholds.
+    """
+    ri, rj, ci, cj = r, r[prev], c, c[prev]
+    lo, hi = np.minimum(ri,rj), np.maximum(ri,rj)
+    # rows with (ri > y) != (rj > y), or (ri < y) != (rj < y)
+    y0 = np.floor(lo)+1 if left else np.ceil(lo)
+    y1 = np.floor(hi)   if left else np.ceil(hi)-1
+    y0, y1 = np.maximum(0, y0).astype(int), np.minimum(ny-1, y1).astype(int)
+    n = np.maximum(0, y1 - y0 + 1)
+    e = np.repeat(np.arange(len(r)), n)
+    y = y0[e] + np.arange(n.sum()) - np.repeat(np.cumsum(n)-n, n)
+
+    x = (cj[e]-ci[e]) * (y-ri[e]) / (rj[e]-ri[e]) + ci[e]
+    base = np.floor(x).astype(int) - 1
+    cand = base[:,np.newaxis] + np.arange(4)
+    _x0, _x1 = ci[e][:,np.newaxis] - cand, cj[e][:,np.newaxis] - cand
+    _y0, _y1 = (ri[e] - y)[:,np.newaxis], (rj[e] - y)[:,np.newaxis]
+    f = (_x0*_y1 - _x1*_y0) / (_y1 - _y0)
+    # first pixel that is not counted (right) or that is counted (left)
+    t = base + np.count_nonzero(f >= 0 if left else f > 0, axis=1)
+
+    order = np.lexsort((t, y, poly[e]))
+    return poly[e][order][0::2], y[order][0::2], np.maximum(0, t[order][0::2]), np.minimum(nx, t[order][1::2])
+
+
+def rasterize_polygons(coord, frame, shape, instance_ids=False, out=None):
+    """Label stack of shape (T,Y,X) with the polygons coord (each (2,n_points)) filled into their frames.
+
+    Pixels of the k-th polygon are set to k+1 if instance_ids (later polygons win where they overlap),
+    otherwise to 255. out is a preallocated stack to fill in.
+
+    All polygons are filled at once along the rows of their bounding boxes. The pixels are the same
+    as when drawing each polygon into its frame with skimage.draw.polygon, including its boundary.
+    """
+    if out is None:
+        dtype = np.uint8 if not instance_ids else np.uint16 if len(coord) < 2**16 else np.uint32
+        out = np.zeros(shape, dtype)
+    ny, nx = out.shape[-2:]
+    keep = [k for k,c in enumerate(coord) if np.shape(c)[-1] > 0]
+    if len(keep) == 0:
+        return out
+
+    r = np.concatenate([np.asarray(coord[k][0], np.float64) for k in keep])
+    c = np.concatenate([np.asarray(coord[k][1], np.float64) for k in keep])
+    n_points = np.array([np.shape(coord[k])[-1] for k in keep])
+    first = np.cumsum(n_points) - n_points
+    prev = np.arange(len(r)) - 1
+    prev[first] = first + n_points - 1
+    poly = np.repeat(np.array(keep), n_points)
+
+    pixels = []
+    # inside if crossings to the right are odd, on the boundary if those to the left are
+    for left in (False, True):
+        k, row, start, stop = _scanline_spans(r, c, prev, poly, ny, nx, left)
+        n = np.maximum(0, stop - start)
+        span = np.repeat(np.arange(len(n)), n)
+        pixels.append((k[span], row[span], start[span] + np.arange(n.sum()) - np.repeat(np.cumsum(n)-n, n)))
+    # vertices on pixel centers (within skimage's tolerance)
+    vr, vc = np.round(r), np.round(c)
+    v = (np.abs(r-vr) < 1e-12) & (np.abs(c-vc) < 1e-12) & (vr >= 0) & (vr < ny) & (vc >= 0) & (vc < nx)
+    pixels.append((poly[v], vr[v].astype(int), vc[v].astype(int)))
+
+    p, row, col = (np.concatenate(a) for a in zip(*pixels))
+    t = np.asarray(frame)[p]
+    if instance_ids:
+        # the pixels of the last (i.e. later) polygon
+        order = np.argsort(p, kind='stable')[::-1]
+        _, last = np.unique(np.ravel_multi_index((t[order],row[order],col[order]), out.shape), return_index=True)
+        t, row, col, p = t[order][last], row[order][last], col[order][last], p[order][last]
+    out[t, row, col] = p+1 if instance_ids else 255
+    return out
+
+
+def _npz_memmap(file):
+    # memory-map all arrays of an uncompressed .npz file (as written by np.savez)
+    arrays = {}
+    with zipfile.ZipFile(str(file)) as z, open(str(file),'rb') as f:
+        for info in z.infolist():
+            info.compress_type == zipfile.ZIP_STORED or _raise(ValueError(f'{file} is compressed'))
+            # skip zip local file header (30 bytes + file name + extra field)
+            f.seek(info.header_offset + 26)
+            n, m = struct.unpack('<HH', f.read(4))
+            f.seek(info.header_offset + 30 + n + m)
+            version = np.lib.format.read_magic(f)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1,0) else np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(f)
+            name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+            if dtype.hasobject:
+                raise ValueError(f'{file} contains pickled objects')
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.empty(shape, dtype)
+            else:
+                arrays[name] = np.memmap(str(file), dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                                         order='F' if fortran_order else 'C')
+    return arrays
+
+
+
+class _PerFrame:
+    # read-only per-frame view of a flat polygon array, like the lists of arrays in the old .npz files
+    def __init__(self, data, frame_offsets):
+        self.data, self.frame_offsets = data, frame_offsets
+
+    def __len__(self):
+        return len(self.frame_offsets) - 1
+
+    def __getitem__(self, t):
+        if not -len(self) <= t < len(self):
+            raise IndexError(t)
+        t %= len(self)
+        return self.data[self.frame_offsets[t]:self.frame_offsets[t+1]]
+
+    def __iter__(self):
+        return (self[t] for t in range(len(self)))
+
+
+
+class PolygonStore:
+    # polygons of all frames of a timelapse in flat arrays: polygon i of frame t is row frame_offsets[t]+i of
+    #   coord (N,2,n_rays) float32, points (N,2) int32, prob (N,) float32, centroid (N,2) float32, area (N,) float32
+    # and frame (N,) is the frame of each row. saved as a pickle-free, uncompressed .npz that can be memory-mapped.
+    # polygons['coord'][t] etc. behave like the per-frame lists of the old .npz files.
+
+    def __init__(self, frame_offsets, coord, points=None, prob=None, centroid=None, area=None, frame=None):
+        self.frame_offsets = np.asarray(frame_offsets)
+        self.coord, self.points, self.prob, self.centroid, self.area = coord, points, prob, centroid, area
+        if frame is None:
+            frame = np.repeat(np.arange(len(self), dtype=np.int32), np.diff(self.frame_offsets))
+        self.frame = frame
+
+
+    @classmethod
+    def from_lists(cls, coord, points=None, prob=None, geometry=True):
+        # from per-frame lists of arrays (e.g. the contents of an old .npz file)
+        counts = [len(c) for c in coord]
+        frame_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        n_rays = next((np.shape(c)[-1] for c in coord if len(c) > 0), 0)
+        def _flat(arrays, dtype, shape):
+            return np.concatenate([np.zeros((0,)+shape, dtype)] + [np.asarray(a, dtype).reshape((len(a),)+shape) for a in arrays])
+        coord = _flat(coord, np.float32, (2,n_rays))
+        points = None if points is None else _flat(points, np.int32, (2,))
+        prob = None if prob is None else _flat(prob, np.float32, ())
+        centroid = area = None
+        if geometry:
+            area, centroid = (a.astype(np.float32) for a in polygon_area_centroid(coord))
+        return cls(frame_offsets, coord, points, prob, centroid, area)
+
+
+    @classmethod
+    def from_polygons(cls, polygons, geometry=True):
+        # from a list of stardist prediction dicts, one per frame
+        return cls.from_lists([p['coord']  for p in polygons],
+                              [p['points'] for p in polygons],
+                              [p['prob']   for p in polygons], geometry=geometry)
+
+
+    @classmethod
+    def load(cls, file, mmap=True):
+        arrays = _npz_memmap(file) if mmap else dict(np.load(str(file)))
+        return cls(**arrays)
+
+
+    def save(self, file):
+        arrays = {k: getattr(self,k) for k in ('frame_offsets','frame','coord','points','prob','centroid','area')}
+        np.savez(str(file), **{k: v for k,v in arrays.items() if v is not None})
+
+
+    def __len__(self):
+        return len(self.frame_offsets) - 1
+
+
+    def __getitem__(self, key):
+        # polygons['coord'][t] or polygons[t,i] -> coordinates of polygon i in frame t
+        if isinstance(key, str):
+            data = getattr(self, key, None) if key in ('coord','points','prob','centroid','area') else None
+            data is not None or _raise(KeyError(key))
+            return _PerFrame(data, self.frame_offsets)
+        t, i = key
+        return self.coord[self.index(t, i)]
+
+
+    def index(self, t, i):
+        # row of polygon i in frame t
+        0 <= i < self.frame_offsets[t+1] - self.frame_offsets[t] or _raise(IndexError((t,i)))
+        return self.frame_offsets[t] + i
+
+
+
+def points_in_polygons(points, coord):
+    # even-odd rule for pairs of points (N,2) and polygons (N,2,n_rays), as matplotlib's Path.contains_points
+    y, x = coord[:,0], coord[:,1]
+    y1, x1 = np.roll(y,-1,axis=1), np.roll(x,-1,axis=1)
+    py, px = points[:,0:1], points[:,1:2]
+    crosses = (y > py) != (y1 > py)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_intersect = x + (py - y) * (x1 - x) / (y1 - y)
+    return np.count_nonzero(crosses & (px < x_intersect), axis=1) % 2 == 1
+
+
+
+class PolygonAssociation:
+    # for every polygon of a PolygonStore, the polygons of another store (same frames) whose centroids it contains,
+    # computed for all frames at once: KD-tree of centroids per frame, bounding box prefilter, exact point-in-polygon test
+
+    def __init__(self, polygons, others):
+        pairs = []
+        for t in range(min(len(polygons), len(others))):
+            a = np.arange(polygons.frame_offsets[t], polygons.frame_offsets[t+1])
+            b = np.arange(others.frame_offsets[t], others.frame_offsets[t+1])
+            if len(a) == 0 or len(b) == 0:
+                continue
+            coord = np.asarray(polygons.coord[a.min():a.max()+1])
+            centroid = np.asarray(others.centroid[b.min():b.max()+1])
+            lo, hi = coord.min(axis=2), coord.max(axis=2)
+            candidates = cKDTree(centroid).query_ball_point((lo+hi)/2, np.linalg.norm(hi-lo, axis=1)/2)
+            i = np.repeat(np.arange(len(a)), [len(c) for c in candidates])
+            j = np.concatenate([np.zeros(0,int)] + [np.asarray(c,int) for c in candidates])
+            inside = np.all((lo[i] <= centroid[j]) & (centroid[j] <= hi[i]), axis=1)
+            i, j = i[inside], j[inside]
+            inside = points_in_polygons(centroid[j], coord[i])
+            pairs.append(np.stack([a[i[inside]], b[j[inside]]], axis=1))
+
+        pairs = np.concatenate([np.zeros((0,2),int)] + pairs)
+        pairs = pairs[np.lexsort((pairs[:,1], pairs[:,0]))]
+        self.polygons, self.others = polygons, others
+        self.indices = pairs[:,1]
+        self.indptr = np.searchsorted(pairs[:,0], np.arange(len(polygons.coord)+1))
+
+
+    def contained(self, t, i):
+        # indices (within frame t of others) of the polygons whose centroids lie inside polygon i of frame t
+        k = self.polygons.index(t, i)
+        return self.indices[self.indptr[k]:self.indptr[k+1]] - self.others.frame_offsets[t]
+
+
+
+def _farthest_pair(centroid):
+    # first pair (i<j) of polygons with the most distant centroids
+    d = np.sqrt(np.sum((centroid[:,np.newaxis] - centroid[np.newaxis])**2, axis=-1))
+    d[np.tril_indices(len(d))] = 0
+    k = np.argmax(d)
+    return np.unravel_index(k, d.shape) if d.flat[k] > 0 else (0,0)
+
+
+def measure_crop(tif_file, rois_tracked, rois_untracked=None, tracked_channel=1, exact=False):
+    # per-frame shape features and mean signal of the (at most two) polygons of a cropped track, as the
+    # dictionaries of Measure_polygons.ipynb; image and polygons are read once and shapes measured for all frames at once.
+    # shapes are computed from the polygons' moments, or if exact by regionprops of the rasterized polygons
+    with profile('measure', tif_file) as record:
+        frames = _measure_crop(tif_file, rois_tracked, rois_untracked, tracked_channel, exact)
+        record['frames'] = len(frames)
+    return frames
+
+
+def _measure_crop(tif_file, rois_tracked, rois_untracked, tracked_channel, exact):
+    image = imread(str(tif_file))
+    if image.ndim == 4:
+        tracked_channel in (1,2) or _raise(ValueError('Got a weird value for tracked_channel! Computer says no.'))
+        images = dict(tracked=image[:,tracked_channel-1], untracked=image[:,2-tracked_channel])
+    else:
+        images = dict(tracked=image)
+
+    frames = [{} for _ in range(len(image))]
+    for key, rois in (('tracked',rois_tracked), ('untracked',rois_untracked)):
+        if rois is None:
+            continue
+        polygons = load_polygons(rois)
+        coord, offsets = polygons.coord, polygons.frame_offsets
+        if exact:
+            features = rasterized_shape_features(coord, polygons.frame, (len(image),)+image.shape[-2:])
+        else:
+            features = polygon_shape_features(coord)
+        for t, frame in enumerate(frames):
+            rows = np.arange(offsets[t], offsets[t+1])
+            # for cell division, more than two polygons in a track is not correct: keep the furthest-separated pair
+            if len(rows) > 2:
+                rows = rows[list(_farthest_pair(features['centroid'][rows]))]
+            # note: the signal is measured in the first (one or two) polygons of the frame, even if others were kept
+            frame[key] = [dict(c    = features['centroid'][k],
+                               area = features['area'][k],
+                               ecc  = features['eccentricity'][k],
+                               sig  = polygon_mean_signal(images[key][t], coord[offsets[t]+i]),
+                               maj  = features['major_axis_length'][k],
+                               min  = features['minor_axis_length'][k]) for i,k in enumerate(rows)]
+
+    for t, frame in enumerate(frames):
+        frame['frame'] = t
+    return frames
+
+
+def load_polygons(file, mmap=True):
+    # polygons saved by PolygonStore.save, or by older versions as per-frame lists (pickled object arrays)
+    with np.load(str(file)) as data:
+        columnar = 'frame_offsets' in data.files
+    if columnar:
+        return PolygonStore.load(file, mmap)
+    with np.load(str(file), allow_pickle=True) as data:
+        return PolygonStore.from_lists(*(data[k] if k in data.files else None for k in ('coord','points','prob')))
+
+
+def to_rgb(timelapse):
+    # normalized TYX or TCYX (2 channels) -> TYX3 for plotting
+    timelapse = np.asarray(timelapse)
+    if timelapse.ndim == 3:
+        timelapse = timelapse[...,np.newaxis]
+        timelapse = np.repeat(timelapse,3,axis=-1)
+    else:
+        timelapse = np.moveaxis(timelapse,1,0)
+        timelapse = np.stack((*timelapse, np.zeros_like(timelapse[0])),axis=-1)
+    return timelapse
+
+
+_DIGITS = ('111101101101111','010110010010111','111001111100111','111001111001111','101101111001001',
+           '111100111001111','111100111101111','111001001001001','111101111101111','111101111001111')
+_DIGITS = np.array([[list(map(int,d[i:i+3])) for i in range(0,15,3)] for d in _DIGITS], bool)
+
+
+def encode_png(rgb, level=6):
+    # 8 bit RGB image (YX3) -> PNG file content
+    rgb = np.ascontiguousarray(rgb, np.uint8)
+    h, w = rgb.shape[:2]
+    raw = np.zeros((h,1+3*w), np.uint8)
+    raw[:,1:] = rgb.reshape(h,-1)
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag+data) & 0xffffffff)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(raw.tobytes(), level)) + chunk(b'IEND', b''))
+
+
+def _draw_text(img, y, x, text, size):
+    # digits of text in black, top left corner at (y,x), each pixel of the 3x5 font is size x size
+    for k,d in enumerate(text):
+        glyph = np.kron(_DIGITS[int(d)], np.ones((size,size), bool))
+        _x = x + k*4*size
+        img[y:y+glyph.shape[0], _x:_x+glyph.shape[1]][glyph] = 0
+
+
+def _draw_outlines(img, coord, origin, shape, scale, color, linewidth=1):
+    """Draw closed polygon outlines into img (YX3), all segments at once.
+
+    coord are polygons (2,n_points) in (unscaled) tile coordinates, each drawn in the tile
+    with top left corner origin (y,x) and size shape (ny,nx) of img, i.e. clipped to the tile.
+    """
+    if len(coord) == 0:
+        return
+    start = np.concatenate([c.T for c in coord]).astype(np.float64)
+    end = np.concatenate([np.roll(c,-1,axis=1).T for c in coord]).astype(np.float64)
+    origin = np.concatenate([np.repeat([o],c.shape[1],axis=0) for o,c in zip(origin,coord)])
+    # pixel centers of the upscaled tile
+    start, end = (start+0.5)*scale-0.5, (end+0.5)*scale-0.5
+    n = np.ceil(np.max(np.abs(end-start),axis=1)).astype(int) + 1
+    seg = np.repeat(np.arange(len(n)), n)
+    t = (np.arange(n.sum()) - np.repeat(np.cumsum(n)-n, n)) / np.repeat(np.maximum(n-1,1), n)
+    points = np.round(start[seg] + t[:,np.newaxis]*(end-start)[seg]).astype(int)
+    for dy in range(linewidth):
+        for dx in range(linewidth):
+            p = points + (dy - linewidth//2, dx - linewidth//2)
+            inside = np.all((p >= 0) & (p < np.asarray(shape)*scale), axis=1)
+            img[origin[seg][inside,0]+p[inside,0], origin[seg][inside,1]+p[inside,1]] = color
+
+
+def plot_track(crop, crop_rois, n_cols=16, scale=4, linewidth=2):
+    """Montage of the frames of a (RGB, normalized) crop with its tracked (white) and untracked (cyan)
+    polygons in crop_rois ('<frame>_tracked' and '<frame>_untracked'), returned as PNG.
+
+    Frames are upscaled by scale and arranged in rows of n_cols tiles, each titled with its frame index.
+    """
+    n_frames, ny, nx = crop.shape[:3]
+    n_rows = int(np.ceil(n_frames / n_cols))
+    font = max(1, scale//2)
+    gap, title = 2*font, 7*font
+    th, tw = title + ny*scale + gap, nx*scale + gap
+    img = np.full((n_rows*th, n_cols*tw, 3), 255, np.uint8)
+
+    tiles = np.round(np.clip(np.asarray(crop, np.float32),0,1)*255).astype(np.uint8)
+    tiles = np.repeat(np.repeat(tiles,scale,axis=1),scale,axis=2)
+    origins = [(t//n_cols*th + title, t%n_cols*tw + gap//2) for t in range(n_frames)]
+    for t,(y,x) in enumerate(origins):
+        img[y:y+ny*scale, x:x+nx*scale] = tiles[t]
+        label = str(t)
+        _draw_text(img, y-6*font, x + (nx*scale - (4*len(label)-1)*font)//2, label, font)
+
+    for key, color in (('tracked',(255,255,255)), ('untracked',(0,255,255))):
+        rois = [(origins[t], np.asarray(r)) for t in range(n_frames) for r in crop_rois.get(f'{t}_{key}',[]) if np.shape(r)[-1] > 0]
+        _draw_outlines(img, [r for _,r in rois], [o for o,_ in rois], (ny,nx), scale, color, linewidth)
+    return encode_png(img)
+
+
+def _crop_labels(shape, rois_list):
+    # binary masks (255) of the per-frame polygons of a crop
+    frame = [t for t,rois in enumerate(rois_list) for _ in rois]
+    return rasterize_polygons([roi for rois in rois_list for roi in rois], frame, (len(rois_list),)+tuple(shape))
+
+
+def _save_polygons(file, coord):
+    PolygonStore.from_lists(coord).save(file)
+
+
+def _write_bytes(file, data):
+    with open(str(file),'wb') as f:
+        f.write(data)
+
+
+def make_crop_dirs(crop_dir, two_colour_analysis, preview=True):
+    # folder structure of the crops of a dataset
+    crop_dir = Path(crop_dir)
+    dirs = dict(tif=crop_dir/'tifs', mask=crop_dir/'mask tifs', polygon=crop_dir/'polygons', rois=crop_dir/'imagej rois')
+    if preview:
+        dirs['preview'] = crop_dir/'preview timelapse'
+    for d in [crop_dir]+list(dirs.values()):
+        d.mkdir(exist_ok=True)
+        if two_colour_analysis and d.name in ('mask tifs','polygons','imagej rois'):
+            (d/'tracked channel').mkdir(exist_ok=True)
+            (d/'untracked channel').mkdir(exist_ok=True)
+    return dirs
+
+
+def crop_writes(T, timelapse, i, slices, crop_rois, name, crop_dir, axes, imagej_metadata=None,
+                two_colour_analysis=False, preview=True, n_cols=16, scale=4):
+    """Files of the i-th cropped track of a dataset, as list of write jobs (function, args, kwargs).
+
+    Cuts the crop (slices of the last two axes) out of T, and the preview out of the normalized
+    timelapse (not needed if preview is False). crop_rois are the per-frame polygons of the track
+    in crop coordinates ('<frame>_tracked' and '<frame>_untracked').
+    """
+    crop_dir = Path(crop_dir)
+    crop_name = f'{name}_crop_{i:03}'
+    channels = ('tracked channel','untracked channel') if two_colour_analysis else ('',)
+    crop = T[((slice(None),)*(T.ndim-2))+slices]
+    n_frames = len(crop)
+
+    writes = [(save_tiff_imagej_compatible, (str(crop_dir/'tifs'/f'{crop_name}.tif'), crop, axes), dict(metadata=imagej_metadata))]
+    for channel, key in zip(channels, ('tracked','untracked')):
+        rois_list = [crop_rois.get(f'{t}_{key}',[]) for t in range(n_frames)]
+        writes += [
+            (export_imagej_rois, (str(crop_dir/'imagej rois'/channel/f'{crop_name}.zip'), rois_list), {}),
+            (_save_polygons, (crop_dir/'polygons'/channel/f'{crop_name}.npz', rois_list), {}),
+            (save_tiff_imagej_compatible, (str(crop_dir/'mask tifs'/channel/f'{crop_name}_mask.tif'),
+                                           _crop_labels(crop.shape[-2:], rois_list), axes[0]+axes[-2:]), dict(compression='zlib')),
+        ]
+    if preview:
+        crop_timelapse = to_rgb(timelapse[((slice(None),)*(T.ndim-2))+slices])
+        writes.append((_write_bytes, (crop_dir/'preview timelapse'/f'{i:03}.png',
+                                      plot_track(crop_timelapse, crop_rois, n_cols=n_cols, scale=scale)), {}))
+    return writes
+
+
+
+class _WriteQueue:
+    # runs write jobs (function, args, kwargs) in a background thread, blocks if maxsize jobs are pending
+
+    def __init__(self, maxsize=16):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._error = None
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def _write(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            if self._error is None:
+                try:
+                    fn, args, kwargs = job
+                    fn(*args, **kwargs)
+                except BaseException as e:
+                    self._error = e
+
+    def put(self, jobs):
+        for job in jobs:
+            if self._error is not None:
+                raise RuntimeError('writing crops failed') from self._error
+            self._queue.put(job)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise RuntimeError('writing crops failed') from self._error
+
+
+def _shared_array(x, directory):
+    # reference to the data of x that a worker process can memory-map instead of receiving a pickled copy;
+    # arrays that are not memory-mapped already are written to a temporary .npy file in directory
+    if isinstance(x, NormalizedView):
+        return ('normalized', _shared_array(x.x, directory), x.mi, x.ma, x.clip, x.eps)
+    if isinstance(x, np.memmap) and isinstance(x.base, mmap.mmap) and x.filename is not None:
+        order = 'F' if x.flags.f_contiguous and not x.flags.c_contiguous else 'C'
+        return ('memmap', x.filename, x.dtype, x.shape, x.offset, order)
+    out = np.lib.format.open_memmap(str(Path(directory)/f'{len(os.listdir(directory))}.npy'), mode='w+', dtype=x.dtype, shape=x.shape)
+    for i in range(0, len(x), 16):
+        out[i:i+16] = x[i:i+16]
+    out.flush()
+    return ('npy', out.filename)
+
+
+def _open_shared(ref):
+    kind, *args = ref
+    if kind == 'normalized':
+        x, mi, ma, clip, eps = args
+        return NormalizedView(_open_shared(x), clip=clip, eps=eps, percentiles=(mi,ma))
+    if kind == 'memmap':
+        file, dtype, shape, offset, order = args
+        return np.memmap(file, dtype, 'r', offset, shape, order)
+    return np.load(args[0], mmap_mode='r')
+
+
+_crop_worker = None
+
+def _init_crop_worker(T, timelapse, settings):
+    # runs once per worker process: open the timelapse (memory-mapped)
+    global _crop_worker
+    _crop_worker = (_open_shared(T), None if timelapse is None else _open_shared(timelapse), settings)
+
+
+def _crop_writes(crop):
+    T, timelapse, settings = _crop_worker
+    return crop_writes(T, timelapse, *crop, **settings)
+
+
+def export_crops(T, timelapse, crops, crop_dir, name, axes, imagej_metadata=None, two_colour_analysis=False,
+                 preview=True, workers=1, queue_size=16, total=None):
+    """Export the cropped tracks of a dataset (see crop_writes) to crop_dir.
+
+    crops is an iterable of (i, slices, crop_rois) for each track. Crops (and previews, unless preview
+    is False) are prepared in a pool of worker processes if workers > 1, which memory-map T and the
+    normalized timelapse. All files are written by a background thread with at most queue_size
+    pending writes. The exported files are identical for any number of workers.
+    """
+    with profile('export_crops', name, frames=T.shape[0]):
+        _export_crops(T, timelapse, crops, crop_dir, name, axes, imagej_metadata, two_colour_analysis, preview, workers, queue_size, total)
+
+
+def _export_crops(T, timelapse, crops, crop_dir, name, axes, imagej_metadata, two_colour_analysis, preview, workers, queue_size, total):
+    make_crop_dirs(crop_dir, two_colour_analysis, preview)
+    settings = dict(name=name, crop_dir=crop_dir, axes=axes, imagej_metadata=imagej_metadata,
+                    two_colour_analysis=two_colour_analysis, preview=preview)
+    timelapse = timelapse if preview else None
+    writer = _WriteQueue(queue_size)
+    try:
+        if workers is None or workers <= 1:
+            for crop in tqdm(crops, total=total):
+                writer.put(crop_writes(T, timelapse, *crop, **settings))
+        else:
+            with tempfile.TemporaryDirectory() as tmp:
+                shared = _shared_array(T, tmp), None if timelapse is None else _shared_array(timelapse, tmp)
+                with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                         initializer=_init_crop_worker, initargs=(*shared, settings)) as pool:
+                    pending = deque()
+                    for crop in tqdm(crops, total=total):
+                        pending.append(pool.submit(_crop_writes, crop))
+                        # bound the number of prepared crops held in memory
+                        if len(pending) >= 2*workers:
+                            writer.put(pending.popleft().result())
+                    while pending:
+                        writer.put(pending.popleft().result())
+    finally:
+        writer.close()
+
+
+def file_fingerprint(file):
+    st = os.stat(str(file))
+    return [st.st_size, st.st_mtime_ns]
+
+
+def params_hash(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def model_identity(model):
+    # name and fingerprints of the weights/config/thresholds files of a csbdeep/stardist model
+    files = sorted(p for p in Path(model.logdir).glob('*') if p.suffix in ('.h5','.json'))
+    return dict(name=model.name, files={p.name: file_fingerprint(p) for p in files})
+
+
+
+class PredictionCheckpoint:
+    """Polygons of consecutive frames committed to directory while they are predicted.
+
+    Each chunk of frames is a PolygonStore .npz file 'start_stop.npz', renamed into place when
+    complete. A checkpoint with different params (e.g. thresholds or model) is discarded.
+    assemble writes the final .npz/.zip one chunk at a time.
+    """
+
+    def __init__(self, directory, params):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        meta = self.directory / 'params.json'
+        if meta.exists() and load_json(str(meta)) != json.loads(json.dumps(params, default=str)):
+            print(f'Discarding checkpoint {self.directory} of other prediction settings')
+            for start, stop, path in self.chunks(contiguous=False):
+                os.remove(str(path))
+        save_json(json.loads(json.dumps(params, default=str)), str(meta))
+
+
+    def chunks(self, contiguous=True):
+        # (start, stop, path) of the committed chunks, by default only those contiguous from frame 0
+        chunks = sorted((int(m[1]), int(m[2]), self.directory/m[0]) for m in
+                        (re.fullmatch(r'(\d+)_(\d+)\.npz', p.name) for p in self.directory.iterdir()) if m)
+        if contiguous:
+            stop = 0
+            for k, (a, b, _) in enumerate(chunks):
+                if a != stop:
+                    return chunks[:k]
+                stop = b
+        return chunks
+
+
+    def committed(self):
+        # number of frames committed from frame 0
+        chunks = self.chunks()
+        return chunks[-1][1] if chunks else 0
+
+
+    def append(self, start, polygons):
+        # commit the polygons (stardist dicts) of frames start, start+1, ...
+        file = self.directory / f'{start:06d}_{start+len(polygons):06d}.npz'
+        tmp = self.directory / f'.{file.stem}.tmp.npz'
+        PolygonStore.from_polygons(polygons).save(tmp)
+        os.replace(str(tmp), str(file))
+
+
+    def assemble(self, rois_python, rois_imagej, n_frames):
+        # PolygonStore .npz and ImageJ .zip (as export_imagej_rois) of all frames, reading one chunk at a time
+        from stardist.utils import polyroi_bytearray
+        chunks = self.chunks()
+        self.committed() == n_frames or _raise(RuntimeError(f'only {self.committed()}/{n_frames} frames were predicted'))
+        counts = []
+        for _, _, path in chunks:
+            with np.load(str(path)) as data:
+                counts.append(np.diff(data['frame_offsets']))
+        counts = np.concatenate(counts) if counts else np.zeros(0, np.int64)
+        frame_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+        with profile('export_rois', rois_imagej, frames=n_frames):
+            tmp = rois_imagej.with_name(f'.{rois_imagej.name}.tmp')
+            with zipfile.ZipFile(str(tmp), mode='w', compression=zipfile.ZIP_DEFLATED) as roizip:
+                for start, _, path in chunks:
+                    chunk = PolygonStore.load(path, mmap=False)
+                    for t in range(len(chunk)):
+                        for i, poly in enumerate(chunk['coord'][t], start=1):
+                            roi = polyroi_bytearray(poly[1], poly[0], pos=start+t+1, subpixel=True)
+                            roizip.writestr(f'{start+t+1:03d}_{i:03d}.roi', roi)
+            os.replace(str(tmp), str(rois_imagej))
+
+        # as PolygonStore.save, an uncompressed .npz
+        with profile('save', rois_python, frames=n_frames):
+            tmp = rois_python.with_name(f'.{rois_python.stem}.tmp.npz')
+            with zipfile.ZipFile(str(tmp), mode='w', compression=zipfile.ZIP_STORED) as npz:
+                with npz.open('frame_offsets.npy', 'w', force_zip64=True) as f:
+                    np.lib.format.write_array(f, frame_offsets)
+                for key in ('frame','coord','points','prob','centroid','area'):
+                    arrays = []
+                    for _, _, path in chunks:
+                        with np.load(str(path)) as data:
+                            arrays.append((data[key].dtype, data[key].shape[1:], len(data[key])))
+                    # shape of the (possibly empty) chunks with polygons
+                    dtype, shape = next(((d, s) for d, s, n in arrays if n > 0), arrays[0][:2] if arrays else (np.float32, ()))
+                    with npz.open(f'{key}.npy', 'w', force_zip64=True) as f:
+                        np.lib.format.write_array_header_1_0(f, dict(descr=np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                                                     fortran_order=False, shape=(int(frame_offsets[-1]),)+tuple(shape)))
+                        for start, _, path in chunks:
+                            with np.load(str(path)) as data:
+                                x = data[key]
+                            if len(x) > 0:
+                                f.write(np.ascontiguousarray(x + start if key == 'frame' else x).tobytes())
+            os.replace(str(tmp), str(rois_python))
+
+
+    def remove(self):
+        for path in self.directory.iterdir():
+            os.remove(str(path))
+        self.directory.rmdir()
+
+
+
+class PredictionCache:
+    """Network outputs (see predict_maps) of frames on disk, as float16, keyed by frame content and model.
+
+    Entries are .npz files in directory, the least recently used are deleted when the cache
+    grows beyond max_mb. Several processes can share a cache.
+    """
+
+    def __init__(self, directory, max_mb=20000):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_mb * 2**20
+        self._size = sum(e.stat().st_size for e in os.scandir(self.directory) if e.name.endswith('.npz'))
+
+
+    @staticmethod
+    def model_key(model):
+        return params_hash(model_identity(model))
+
+
+    @staticmethod
+    def key(frame, model_key):
+        # raw (not normalized) frame, predictions are always of frames normalized with percentiles (1,99.8)
+        frame = np.ascontiguousarray(frame)
+        h = hashlib.sha1(f'{model_key} {frame.dtype.str} {frame.shape} 1 99.8'.encode())
+        h.update(memoryview(frame).cast('B'))
+        return h.hexdigest()
+
+
+    def _file(self, key):
+        return self.directory / f'{key}.npz'
+
+
+    def get(self, key):
+        # (prob, dist) or None
+        try:
+            with np.load(str(self._file(key))) as data:
+                maps = data['prob'], data['dist']
+            os.utime(str(self._file(key)))
+            return maps
+        except (FileNotFoundError, ValueError, OSError, zipfile.BadZipFile):
+            return None
+
+
+    def put(self, key, prob, dist):
+        # store and return the float16 maps
+        prob, dist = np.asarray(prob, np.float16), np.asarray(dist, np.float16)
+        file = self._file(key)
+        tmp = file.with_name(f'.{file.name}.{os.getpid()}.tmp')
+        with open(str(tmp), 'wb') as f:
+            np.savez(f, prob=prob, dist=dist)
+        os.replace(str(tmp), str(file))
+        self._size += file.stat().st_size
+        if self._size > self.max_bytes:
+            self.evict()
+        return prob, dist
+
+
+    def evict(self, fraction=0.9):
+        # delete the least recently used entries until the cache is below fraction*max_mb
+        entries = sorted(((e.stat().st_mtime_ns, e.stat().st_size, e.path) for e in os.scandir(self.directory) if e.name.endswith('.npz')))
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self._size <= fraction * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+
+
+
+def _match_frames(polygons, reference, shape, iou_thresh):
+    # matching statistics (stardist.matching) of the polygons of all frames with the reference polygons
+    from stardist.matching import matching_dataset
+    labels = [rasterize_polygons(p.coord, p.frame, shape, instance_ids=True) for p in (reference, polygons)]
+    stats = matching_dataset(list(labels[0]), list(labels[1]), thresh=iou_thresh, show_progress=False)._asdict()
+    return {k: getattr(v, 'item', lambda: v)() for k, v in stats.items() if k not in ('criterion','thresh','by_image')}
+
+
+_sweep_reference = {}
+
+def _sweep_setting(cache_dir, keys, shape, grid, prob_thresh, nms_thresh, reference=None, iou_thresh=0.5):
+    # NMS of all cached frames with one setting of thresholds, compared with reference polygons (.npz file)
+    cache = PredictionCache.__new__(PredictionCache)
+    cache.directory = Path(cache_dir)
+    polygons = []
+    for key in keys:
+        maps = cache.get(key)
+        maps is not None or _raise(FileNotFoundError('predictions were evicted from the cache, increase prediction_cache_mb'))
+        polygons.append(polygons_from_maps(*maps, shape[1:], grid, prob_thresh, nms_thresh))
+    result = dict(prob_thresh=prob_thresh, nms_thresh=nms_thresh, n_objects=sum(len(p['prob']) for p in polygons),
+                  n_objects_per_frame=[len(p['prob']) for p in polygons])
+    if reference is not None:
+        if reference not in _sweep_reference:
+            _sweep_reference[reference] = load_polygons(reference, mmap=False)
+        result.update(_match_frames(PolygonStore.from_polygons(polygons, geometry=False),
+                                    _sweep_reference[reference], shape, iou_thresh))
+    return result
+
+
+
+class Manifest:
+    # records for each stage of a raw file the fingerprints of the input files, a hash of the relevant
+    # settings, the model identity and the (fingerprinted) output files, stored as '<directory>/<name>.json'
+    # with name being the stem of the raw file
+
+    def __init__(self, directory, name):
+        self.path = Path(directory) / f'{name}.json'
+        self.stages = self._load()
+
+
+    def _load(self):
+        return load_json(str(self.path)) if self.path.exists() else {}
+
+
+    def _entry(self, inputs, params, model=None):
+        return dict (
+            inputs = {str(f): file_fingerprint(f) for f in inputs},
+            params = params_hash(params),
+            model  = None if model is None else model_identity(model),
+        )
+
+
+    def up_to_date(self, stage, inputs, params, model=None):
+        # true if stage was completed with the same inputs, settings and model, and its outputs are untouched
+        entry = self.stages.get(stage)
+        if entry is None:
+            return False
+        try:
+            current = self._entry(inputs, params, model)
+            return (all(entry[k] == v for k,v in current.items()) and
+                    all(file_fingerprint(f) == v for f,v in entry['outputs'].items()))
+        except FileNotFoundError:
+            return False
+
+
+    def outputs(self, stage):
+        return [Path(f) for f in self.stages[stage]['outputs']]
+
+
+    def record(self, stage, inputs, params, outputs, model=None):
+        entry = self._entry(inputs, params, model)
+        entry['outputs'] = {str(f): file_fingerprint(f) for f in outputs}
+        # re-read, other stages of this file may have been recorded in the meantime
+        self.stages = self._load()
+        self.stages[stage] = entry
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix('.json.tmp')
+        save_json(self.stages, str(tmp))
+        os.replace(str(tmp), str(self.path))
+
+
+
+class DatasetRegistry:
+    """Files of all datasets in base_dir, keyed by the exact stem of the raw file (and crop index).
+
+    The folders of the notebooks are scanned once, e.g. 'stardist results/channel 1/DRIFTCORRECTED_x_prob=default_nms=default.npz'
+    is registered as registry.path('x', 'rois_python/channel 1'). Directory listings are kept in
+    '<base_dir>/registry.json', such that later scans only list directories that were modified since.
+    With a config, its data_dir, registered_dir, results_dir and tracks_dir are scanned instead of the default folders.
+    """
+
+    dirs = dict(raw='raw data', registered='registered data', rois='stardist results', tracks='tracking results', crops='results')
+    prefix = 'DRIFTCORRECTED_'
+    crop_kinds = {'tifs': 'tif', 'mask tifs': 'mask', 'polygons': 'polygons', 'imagej rois': 'rois', 'preview timelapse': 'preview'}
+
+    def __init__(self, base_dir, index_file='registry.json', config=None):
+        self.base_dir = Path(base_dir)
+        self.index_file = self.base_dir / index_file
+        if config is not None:
+            dirs = dict(raw=config.data_dir, registered=config.registered_dir, rois=config.results_dir, tracks=config.tracks_dir)
+            self.dirs = {**self.dirs, **{kind: Path(d).as_posix() for kind, d in dirs.items() if d is not None}}
+        self.update()
+
+
+    def update(self):
+        # rescan, listing only new or modified directories
+        old = load_json(str(self.index_file)) if self.index_file.exists() else {}
+        listing = {}
+        for d in set(self.dirs.values()):
+            self._walk(d, old, listing)
+        if listing != old:
+            tmp = self.index_file.with_suffix('.json.tmp')
+            save_json(listing, str(tmp))
+            os.replace(str(tmp), str(self.index_file))
+        self._register(listing)
+
+
+    def _walk(self, key, old, listing):
+        d = self.base_dir / key
+        try:
+            mtime = os.stat(str(d)).st_mtime_ns
+        except FileNotFoundError:
+            return
+        entry = old.get(key)
+        if entry is None or entry['mtime'] != mtime:
+            with os.scandir(str(d)) as it:
+                entries = list(it)
+            # a directory modified just now may change again within the file system's time resolution
+            recent = time.time_ns() - mtime < 2e9
+            entry = dict (
+                mtime = None if recent else mtime,
+                dirs  = sorted(e.name for e in entries if e.is_dir()),
+                files = sorted(e.name for e in entries if e.is_file()),
+            )
+        listing[key] = entry
+        for sub in entry['dirs']:
+            self._walk(f'{key}/{sub}', old, listing)
+
+
+    def _dataset(self, stem):
+        return stem[len(self.prefix):] if stem.startswith(self.prefix) else stem
+
+
+    def _register(self, listing):
+        self._files, self._crops = {}, {}
+        def add(table, key, kind, path):
+            if table.setdefault(key, {}).setdefault(kind, path) != path:
+                print(f"Ambiguous {kind} files for '{key}', using {table[key][kind]} (not {path})")
+
+        for key, kind in sorted((key, kind) for key in listing for kind, d in self.dirs.items() if key == d or key.startswith(d+'/')):
+            sub = [s for s in key[len(self.dirs[kind]):].split('/') if s]
+            for name in listing[key]['files']:
+                path, stem, ext = self.base_dir / key / name, Path(name).stem, Path(name).suffix.lower()
+                if kind in ('raw','registered') and ext in ('.tif','.tiff'):
+                    add(self._files, stem if kind == 'raw' else self._dataset(stem), kind, path)
+                elif kind == 'rois' and ext in ('.npz','.zip'):
+                    m = re.fullmatch(r'(.*)_prob=.*_nms=[^_]*', stem)
+                    if m is not None:
+                        rois = 'rois_python' if ext == '.npz' else 'rois_imagej'
+                        add(self._files, self._dataset(m.group(1)), '/'.join([rois]+sub), path)
+                elif kind == 'tracks' and ext == '.csv' and stem.endswith('_tracks'):
+                    add(self._files, self._dataset(stem[:-len('_tracks')]), 'tracks', path)
+                elif kind == 'crops' and len(sub) >= 2 and sub[0].startswith('crops_') and sub[1] in self.crop_kinds:
+                    dataset = sub[0][len('crops_'):]
+                    m = re.fullmatch(r'(\d+)' if sub[1] == 'preview timelapse' else re.escape(dataset)+r'_crop_(\d+)(_mask)?', stem)
+                    if m is not None:
+                        add(self._crops.setdefault(dataset, {}), m.group(1), '/'.join([self.crop_kinds[sub[1]]]+sub[2:]), path)
+
+        # rois in a single channel folder (e.g. of a single-colour dataset) are also the dataset's 'rois_python'/'rois_imagej'
+        for files in self._files.values():
+            for rois in ('rois_python', 'rois_imagej'):
+                channels = [kind for kind in files if kind.startswith(rois+'/')]
+                if rois not in files and len(channels) == 1:
+                    files[rois] = files[channels[0]]
+
+
+    def datasets(self, kind='raw'):
+        # stems of all datasets that have a file of this kind, or exported crops if kind is 'crops'
+        if kind == 'crops':
+            return sorted(self._crops)
+        return sorted(stem for stem, files in self._files.items() if kind in files)
+
+
+    def files(self, stem):
+        return self._files.get(stem, {})
+
+
+    def path(self, stem, kind):
+        try:
+            return self._files[stem][kind]
+        except KeyError:
+            raise FileNotFoundError(f"No {kind} file for dataset '{stem}' in {self.base_dir}")
+
+
+    def crop_indices(self, stem):
+        # indices (e.g. '007') of the exported crops of a dataset
+        return sorted(i for i, files in self._crops.get(stem, {}).items() if 'tif' in files)
+
+
+    def crop(self, stem, index):
+        # files of a crop, e.g. crop['tif'], crop['polygons/tracked channel']
+        try:
+            return self._crops[stem][index]
+        except KeyError:
+            raise FileNotFoundError(f"No crop {index} of dataset '{stem}' in {self.base_dir}")
+
+
+
+def _peak_rss():
+    # peak resident set size (bytes) since the last _reset_peak_rss on Linux, otherwise of the whole process
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        # kilobytes on Linux, bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    except ImportError:
+        return 0
+
+
+def _reset_peak_rss():
+    # keep the peaks of open profiler stages
+    if _profiler is not None:
+        _profiler._update_peaks()
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+class Profiler:
+    """Records wall time, CPU time, frames/s and peak RSS of pipeline stages as JSON lines.
+
+    Stages (see profile) can be nested, the peak RSS of a stage includes its nested stages.
+    Each finished stage is appended to file as one line, so several processes can share a file.
+    """
+
+    def __init__(self, file):
+        self.file = Path(file)
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        self._fd = os.open(str(self.file), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._lock = threading.Lock()
+        self._open = []
+
+
+    def _update_peaks(self):
+        rss = _peak_rss()
+        for record in self._open:
+            record['peak_rss'] = max(record['peak_rss'], rss)
+
+
+    @contextmanager
+    def stage(self, name, file=None, frames=None):
+        # yields the record, e.g. to set 'frames' once known
+        record = dict(stage=name, file=None if file is None else str(file), frames=frames, peak_rss=0)
+        with self._lock:
+            self._update_peaks()
+            _reset_peak_rss()
+            self._open.append(record)
+        start, wall, cpu = time.time(), time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            wall, cpu = time.perf_counter()-wall, time.process_time()-cpu
+            with self._lock:
+                self._update_peaks()
+                self._open.remove(record)
+            frames = record['frames']
+            line = dict(stage=name, file=record['file'], frames=frames, start=start, wall=wall, cpu=cpu,
+                        fps=frames/wall if frames and wall > 0 else None, peak_rss_mb=record['peak_rss']/2**20,
+                        pid=os.getpid(), tid=threading.get_ident())
+            # a single append per line, atomic for concurrent writers
+            os.write(self._fd, (json.dumps(line)+'\n').encode())
+
+
+    def close(self):
+        os.close(self._fd)
+
+
+_profiler = None
+
+def enable_profiling(file):
+    # record all stages of this process (see profile) to the JSON lines file, or stop recording if file is None
+    global _profiler
+    if _profiler is not None:
+        _profiler.close()
+    _profiler = None if file is None else Profiler(file)
+    return _profiler
+
+
+def profile(stage, file=None, frames=None):
+    # context manager timing a stage if profiling is enabled, otherwise does nothing
+    return nullcontext({}) if _profiler is None else _profiler.stage(stage, file, frames)
+
+
+@contextmanager
+def _profile_nms(model, file):
+    # time StarDist's non-maximum suppression (called by predict_instances and predict_instances_batch) as nested 'nms' stages
+    if _profiler is None or not hasattr(model, '_instances_from_prediction'):
+        yield
+        return
+    nms = model._instances_from_prediction
+    def _nms(*args, **kwargs):
+        with profile('nms', file, frames=1):
+            return nms(*args, **kwargs)
+    model._instances_from_prediction = _nms
+    try:
+        yield
+    finally:
+        del model._instances_from_prediction
+
+
+def read_profile(file):
+    with open(str(file)) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def profile_summary(file):
+    # total wall and CPU time, frames/s and peak RSS per file and stage of a profile (nested stages are included in their parents)
+    summary = {}
+    for r in read_profile(file):
+        s = summary.setdefault((r['file'], r['stage']), dict(file=r['file'], stage=r['stage'], calls=0, wall=0.0, cpu=0.0, frames=0, peak_rss_mb=0.0))
+        s['calls'] += 1
+        s['wall'] += r['wall']
+        s['cpu'] += r['cpu']
+        s['frames'] += r['frames'] or 0
+        s['peak_rss_mb'] = max(s['peak_rss_mb'], r['peak_rss_mb'])
+    for s in summary.values():
+        s['fps'] = s['frames']/s['wall'] if s['frames'] and s['wall'] > 0 else None
+    return list(summary.values())
+
+
+def write_chrome_trace(file, trace_file):
+    # convert a profile to the Chrome trace format, to be viewed with chrome://tracing or https://ui.perfetto.dev
+    events = [dict(name=r['stage'], cat='starchaea', ph='X', ts=r['start']*1e6, dur=r['wall']*1e6, pid=r['pid'], tid=r['tid'],
+                   args={k: r[k] for k in ('file','frames','cpu','fps','peak_rss_mb')}) for r in read_profile(file)]
+    save_json(dict(traceEvents=events, displayTimeUnit='ms'), str(trace_file))
+
+
+
+def limit_tf_threads(n_threads):
+    # pin tensorflow's thread pools, must be called before the first session/op is created
+    import tensorflow as tf
+    if tf.__version__.startswith('1.'):
+        # the session that keras (hence stardist) uses for all models
+        from csbdeep.utils.tf import keras_import
+        K = keras_import('backend')
+        config = tf.compat.v1.ConfigProto(intra_op_parallelism_threads=n_threads, inter_op_parallelism_threads=1)
+        K.set_session(tf.compat.v1.Session(config=config))
+    else:
+        tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+_worker = None
+
+def _init_worker(config, n_threads):
+    # runs once per worker process: pin threads and load the models, which are then reused for every file
+    global _worker, _cpu_budget
+    _cpu_budget = n_threads
+    if config.model_server is None:
+        limit_tf_threads(n_threads)
+    # no progress bars of the workers, run_all shows the progress over files
+    _worker = Starchaea(config, progress=False)
+    _worker.init()
+    _worker.load_models()
+
+
+def _run_file(file):
+    return _worker.run(file)
+
+
+
 class Starchaea:
 
-    def __init__(self, config):
+    def __init__(self, config, progress=True):
         if isinstance(config,str):
             self.config = Config.load(config)
         else:
             # isinstance(config, Config) or _raise(ValueError('not a config'))
             self.config = config
+        self.progress = progress
         self._check_config()
 
 
+    def _tqdm(self, *args, **kwargs):
+        # progress bar, unless disabled (e.g. in worker processes)
+        return tqdm(*args, disable=not self.progress, **kwargs)
+
+
     def _check_config(self):
         # be as through as you want, or simply hope for the best
         c = self.config
@@ -79,6 +1841,10 @@ class Starchaea:
         assert c.channel_drift_correction is None or c.channel_drift_correction in channels_allowed
         assert 1 <= len(c.channels_segment) <= 2 and channels_allowed.union(set(c.channels_segment)) == channels_allowed
         assert c.channel_track in channels_allowed
+        assert c.predict_batch_size is None or int(c.predict_batch_size) >= 1
+        assert c.drift_correction_backend in ('ird','phase')
+        assert int(c.drift_correction_downsample) >= 1
+        assert c.predict_memory_mb is None or c.predict_memory_mb > 0
 
 
     def init(self):
@@ -100,6 +1866,16 @@ class Starchaea:
         for name in c.channels_segment:
             (self.stardist_dir / name).mkdir(exist_ok=True, parents=True)
 
+        self.manifest_dir = None if c.manifest_dir is None else self.base_dir / c.manifest_dir
+
+        if c.profile_file is not None:
+            enable_profiling(self.base_dir / c.profile_file)
+            print(f'Profiling to {self.base_dir / c.profile_file}')
+
+        if c.tracks_dir is not None:
+            self.tracks_dir = self.base_dir / c.tracks_dir
+            self.tracks_dir.mkdir(exist_ok=True, parents=True)
+
         print('Successfully created save directories, yay!')
 
 
@@ -107,6 +1883,16 @@ class Starchaea:
         c = self.config
         d = c._asdict()
         self.models = {}
+        if c.model_server is not None:
+            for name in c.channels_segment:
+                self.models[name] = dict (
+                    model       = RemoteModel(c.model_server, d[name+'_model']),
+                    prob_thresh = d[name+'_prob_thresh'],
+                    nms_thresh  = d[name+'_nms_thresh'],
+                )
+            return
+        import keras.backend as K
+        from stardist.models import StarDist2D
         K.clear_session()
         for name in c.channels_segment:
             self.models[name] = dict (
@@ -116,10 +1902,13 @@ class Starchaea:
             )
 
 
-    def load_timelapse(self, file):
-        c = self.config
-        print(f'Loading image from {file}')
-        T = imread(str(file))
+    def manifest(self, file):
+        return None if self.manifest_dir is None else Manifest(self.manifest_dir, Path(file).stem)
+
+
+    def _read_tcyx(self, file, lazy=None):
+        lazy = self.config.lazy_loading if lazy is None else lazy
+        T = imread_lazy(file) if lazy else imread(str(file))
 
         if T.ndim==3:
             axes = 'TYX'
@@ -129,7 +1918,30 @@ class Starchaea:
             raise ValueError('Image shape has incorrect number of dimensions')
 
         # normalize image to always have channel axis
-        T = move_image_axes(T, axes, 'TCYX', adjust_singletons=True)
+        if not lazy:
+            T = move_image_axes(T, axes, 'TCYX', adjust_singletons=True)
+        else:
+            T = _lazy_tcyx(T)
+        return T, axes
+
+
+    def _tcyx_shape(self, file):
+        # shape of the timelapse as read by _read_tcyx, from the TIFF metadata only
+        with TiffFile(str(file)) as tif:
+            shape = tuple(tif.series[0].shape)
+        if len(shape) == 3:
+            return (shape[0], 1) + shape[1:]
+        elif len(shape) == 4:
+            return shape
+        raise ValueError('Image shape has incorrect number of dimensions')
+
+
+    def load_timelapse(self, file):
+        c = self.config
+        print(f'Loading image from {file}')
+        with profile('load', file) as record:
+            T, axes = self._read_tcyx(file)
+            record['frames'] = T.shape[0]
 
         print(f'Data has axes {axes} with shape {T.shape}')
 
@@ -139,7 +1951,25 @@ class Starchaea:
             return T#, axes
 
 
-    def register(self, T, reg_ch):
+    def register(self, T, reg_ch, out=None):
+        # registered timelapse, written to out (e.g. a memory-mapped array) if provided
+        if self.config.drift_correction_backend == 'phase':
+            return self._register_phase(T, reg_ch, out)
+        else:
+            return self._register_ird(T, reg_ch, out)
+
+
+    def _register_phase(self, T, reg_ch, out=None):
+        c = self.config
+        print('Running drift correction...')
+        shifts = estimate_drift(T, downsample=c.drift_correction_downsample, workers=c.drift_correction_workers,
+                                channel=None if T.ndim==3 else reg_ch)
+        return shift_frames(T, shifts, out=out)
+
+
+    def _iter_register_ird(self, T, reg_ch):
+        # reference implementation: register each frame to the previously registered frame
+        import imreg_dft as ird
 
         if T.ndim==3:
             reg_ch = None
@@ -147,61 +1977,227 @@ class Starchaea:
         def _reg(x):
             return x if reg_ch is None else x[reg_ch]
 
-        R = [T[0]]
-
-        print('Running drift correction...')
+        prev = np.asarray(T[0])
+        yield prev
 
-        for frame in tqdm(T[1:]):
-            result = ird.translation(_reg(R[-1]), _reg(frame))
+        for t in self._tqdm(range(1,T.shape[0])):
+            frame = np.asarray(T[t])
+            result = ird.translation(_reg(prev), _reg(frame))
             if reg_ch is None:
                 freg = ird.transform_img(frame, tvec=result["tvec"])
             else:
                 freg = np.stack([ird.transform_img(c, tvec=result["tvec"]) for c in frame])
-            R.append(freg)
+            yield freg
+            prev = freg
 
-        reg = np.stack(R)
 
-        return reg
+    def _register_ird(self, T, reg_ch, out=None):
+        if out is None:
+            out = np.empty(T.shape, np.float64)
+        for t, freg in enumerate(self._iter_register_ird(T, reg_ch)):
+            out[t] = freg
+        return out
+
+
+    def iter_register(self, T, reg_ch):
+        # registered frames one by one, already cast back to the data type of T
+        c = self.config
+        if c.drift_correction_backend == 'phase':
+            print('Running drift correction...')
+            shifts = estimate_drift(T, downsample=c.drift_correction_downsample, workers=c.drift_correction_workers,
+                                    channel=None if T.ndim==3 else reg_ch)
+            for t in self._tqdm(range(T.shape[0])):
+                yield shift_frames(T[t:t+1], shifts[t:t+1])[0].astype(T.dtype)
+        else:
+            for freg in self._iter_register_ird(T, reg_ch):
+                yield freg.astype(T.dtype)
+
+
+    def iter_drift_correction(self, T, file):
+        # stream registered frames to 'DRIFTCORRECTED_*.tif' while yielding them to the caller
+        c = self.config
+        assert c.channel_drift_correction is not None
+        reg_file = self.registered_dir / ('DRIFTCORRECTED_' + file.name)
+        reg_ch = c.channel_order.index(c.channel_drift_correction)
+
+        with TiffStreamWriter(reg_file, T.shape, T.dtype) as writer:
+            for frame in self.iter_register(T, reg_ch):
+                writer.append(frame)
+                yield frame
+
+
+    def _registration_params(self, shape):
+        c = self.config
+        return dict(shape=list(shape), **{k: getattr(c,k) for k in (
+            'channel_order', 'channel_drift_correction', 'drift_correction_backend', 'drift_correction_downsample')})
+
+
+    def _prediction_params(self, shape, channel):
+        c, model = self.config, self.models[channel]
+        params = dict(shape=list(shape), channel_order=c.channel_order,
+                      prob_thresh=model['prob_thresh'], nms_thresh=model['nms_thresh'])
+        if c.predict_memory_mb is not None:
+            # determines the tiles/blocks (with the shape and model), which can change the polygons
+            params['predict_memory_mb'] = c.predict_memory_mb
+        if c.prediction_cache_dir is not None:
+            # polygons from float16 network outputs
+            params['prediction_cache'] = True
+        return params
+
+
+    def _prediction_input(self, file):
+        # file the predictions are computed from
+        c = self.config
+        if c.channel_drift_correction is None:
+            return file
+        return self.registered_dir / ('DRIFTCORRECTED_' + file.name)
+
+
+    def up_to_date(self, file):
+        # true if registration and predictions of all channels are up to date for this raw file
+        m = self.manifest(file)
+        if m is None:
+            return False
+        shape = self._tcyx_shape(file)
+        if self.config.channel_drift_correction is not None:
+            if not m.up_to_date('registration', [file], self._registration_params(shape)):
+                return False
+        if not all(m.up_to_date(f'prediction/{channel}', [self._prediction_input(file)],
+                                self._prediction_params(shape, channel), model['model'])
+                   for channel, model in self.models.items()):
+            return False
+        return self.config.tracks_dir is None or m.up_to_date('tracking', [self._rois_python(file)], {})
 
 
     def drift_correction(self, T, file):
         c = self.config
         assert c.channel_drift_correction is not None
 
-        # check if file already exists?
         reg_file = self.registered_dir / ('DRIFTCORRECTED_' + file.name)
 
         reg_ch = c.channel_order.index(c.channel_drift_correction)
-        T_reg = self.register(T, reg_ch)
-        T_reg = T_reg.astype(T.dtype)
+
+        m = self.manifest(file)
+        params = self._registration_params(T.shape)
+        if m is not None and m.up_to_date('registration', [file], params):
+            print(f'Drift-corrected data in {reg_file} is up to date')
+            return self._read_tcyx(reg_file)[0]
 
         # with TiffFile(str(file)) as _file:
         #     imagej_metadata = _file.imagej_metadata
         #     ome_metadata = _file.ome_metadata
         # save_tiff_imagej_compatible(str(reg_file), T_reg, axes=axes, metadata=imagej_metadata)
 
-        save_tiff_imagej_compatible(str(reg_file), T_reg, axes='TCYX')
-
-        return T_reg
+        if c.lazy_loading:
+            # stream to file and memory-map the result
+            with profile('register', file, frames=T.shape[0]):
+                for _ in self.iter_drift_correction(T, file):
+                    pass
+            T_reg = _lazy_tcyx(imread_lazy(reg_file))
+        else:
+            with profile('register', file, frames=T.shape[0]):
+                T_reg = self.register(T, reg_ch, out=np.empty(T.shape, T.dtype))
+            with profile('save', file, frames=T.shape[0]):
+                save_tiff_imagej_compatible(str(reg_file), T_reg, axes='TCYX')
 
+        if m is not None:
+            m.record('registration', [file], params, [reg_file])
 
-    def _predict_stardist(self, model, file, T, channel, prob_thresh, nms_thresh, out_dir):
+        return T_reg
 
-        axes = 'TCYX'
-        # if T.ndim==3:
-        #     timelapse = T
-        if T.ndim==4:
-            timelapse = T[:,channel]
-        else:
-            raise ValueError('Data has unexpected number of dimensions. Weird.')
 
-        # normalise
-        print(f'Normalizing each frame to run Stardist', flush=True)
-        timelapse = np.stack([normalize(frame, 1,99.8) for frame in timelapse])
-        print(f"Timelapse has axes {axes.replace('C','')} with shape {timelapse.shape}")
+    def _prediction_tiling(self, model, shape):
+        # tiling of frames within predict_memory_mb (None: whole frames), the server of a RemoteModel decides itself
+        memory_mb = self.config.predict_memory_mb
+        if memory_mb is None or isinstance(model, RemoteModel):
+            return None
+        tiling = prediction_tiling(model, shape, memory_mb)
+        blocks = 'whole frames' if tiling['block_size'] is None else f"blocks of {tiling['block_size']} px"
+        print(f"Predicting {blocks} with n_tiles={tiling['n_tiles']} (estimated {tiling['memory_mb']:.0f} MB, budget {memory_mb} MB)")
+        return tiling
 
-        polygons = [model.predict_instances(frame, nms_thresh=nms_thresh, prob_thresh=prob_thresh)[1] for frame in tqdm(timelapse)]
 
+    def _prediction_cache(self, model):
+        # PredictionCache if configured, not for models of a server
+        c = self.config
+        if c.prediction_cache_dir is None or isinstance(model, RemoteModel):
+            return None
+        return PredictionCache(Path(c.base_dir) / c.prediction_cache_dir, c.prediction_cache_mb)
+
+
+    def _cached_maps(self, model, cache, frames, file=None):
+        # network outputs of raw frames (N,Y,X), predicted and cached if not in the cache
+        model_key = PredictionCache.model_key(model)
+        keys = [cache.key(frame, model_key) for frame in frames]
+        maps = [cache.get(key) for key in keys]
+        missing = [j for j, m in enumerate(maps) if m is None]
+        if missing:
+            with profile('normalize', file, frames=len(missing)):
+                timelapse = normalize_timelapse(frames[missing], 1,99.8)
+            for j, prob, dist in zip(missing, *predict_maps(model, timelapse)):
+                maps[j] = cache.put(keys[j], prob, dist)
+        return keys, maps
+
+
+    def _predict_frames_cached(self, model, cache, T, channel, prob_thresh, nms_thresh, file=None, start=0):
+        # polygons from cached network outputs, which are always float16 (also when just predicted) so that
+        # results do not depend on the state of the cache, but can differ slightly from _predict_frames without cache
+        if prob_thresh is None: prob_thresh = model.thresholds.prob
+        if nms_thresh  is None: nms_thresh  = model.thresholds.nms
+        batch_size = self.config.predict_batch_size or 1
+        for i in self._tqdm(range(start, T.shape[0], batch_size)):
+            frames = np.asarray(T[i:i+batch_size,channel])
+            with profile('predict', file, frames=len(frames)):
+                _, maps = self._cached_maps(model, cache, frames, file)
+            for prob, dist in maps:
+                with profile('nms', file, frames=1):
+                    yield polygons_from_maps(prob, dist, frames.shape[1:], model.config.grid, prob_thresh, nms_thresh)
+
+
+    def _predict_frames(self, model, T, channel, prob_thresh, nms_thresh, file=None, start=0):
+        # normalize and predict chunks of frames (from frame start), which are only read from T when needed
+        batch_size = self.config.predict_batch_size or 1
+        tiling = self._prediction_tiling(model, T.shape[2:])
+        cache = self._prediction_cache(model)
+        if cache is not None and tiling is not None and (tiling['block_size'] is not None or tiling['n_tiles'] != (1,1)):
+            print('Not using the prediction cache for tiled prediction')
+            cache = None
+        if cache is not None:
+            yield from self._predict_frames_cached(model, cache, T, channel, prob_thresh, nms_thresh, file, start)
+            return
+        if tiling is not None:
+            # batches only of whole, untiled frames that fit into the budget together
+            if tiling['block_size'] is not None or tiling['n_tiles'] != (1,1):
+                batch_size = 1
+            else:
+                batch_size = max(1, min(batch_size, int(self.config.predict_memory_mb // tiling['memory_mb'])))
+        # measured peak memory of the tiled prediction, only when profiling (resetting the peak writes to /proc)
+        measure_peak = tiling is not None and _profiler is not None
+        peak = 0
+        with _profile_nms(model, file):
+            for i in self._tqdm(range(start, T.shape[0], batch_size)):
+                n = min(batch_size, T.shape[0]-i)
+                with profile('normalize', file, frames=n):
+                    timelapse = normalize_timelapse(T[i:i+batch_size,channel], 1,99.8)
+                if measure_peak:
+                    _reset_peak_rss()
+                    rss = _peak_rss()
+                # includes the nested 'nms' stages
+                with profile('predict', file, frames=n):
+                    if batch_size == 1 and tiling is not None:
+                        polygons = [predict_instances_tiled(model, timelapse[0], tiling, prob_thresh=prob_thresh, nms_thresh=nms_thresh)]
+                    elif batch_size == 1:
+                        polygons = [model.predict_instances(timelapse[0], nms_thresh=nms_thresh, prob_thresh=prob_thresh)[1]]
+                    else:
+                        polygons = predict_instances_batch(model, timelapse, prob_thresh=prob_thresh, nms_thresh=nms_thresh)
+                if measure_peak:
+                    peak = max(peak, (_peak_rss()-rss)/n)
+                yield from polygons
+        if measure_peak:
+            print(f'Peak memory of prediction: {peak/2**20:.0f} MB per frame (resident, above the memory in use before)')
+
+
+    def _roi_path(self, file, prob_thresh, nms_thresh, out_dir):
         if prob_thresh is None:
             prob_string = 'default'
         else:
@@ -212,30 +2208,475 @@ class Starchaea:
         else:
             nms_string = f'{nms_thresh:.2f}'
 
-        roi_path = out_dir / f"{file.stem}_prob={prob_string}_nms={nms_string}"
+        return out_dir / f"{file.stem}_prob={prob_string}_nms={nms_string}"
+
+
+    def _rois_python(self, file, channel=None):
+        # polygons predicted for a channel (default: tracking channel)
+        c = self.config
+        channel = c.channel_track if channel is None else channel
+        d = c._asdict()
+        return Path(str(self._roi_path(file, d[channel+'_prob_thresh'], d[channel+'_nms_thresh'], self.stardist_dir / channel))+'.npz')
+
+
+    def _predict_stardist(self, model, file, T, channel, prob_thresh, nms_thresh, out_dir):
+
+        axes = 'TCYX'
+        # if T.ndim==3:
+        #     timelapse = T
+        if T.ndim!=4:
+            raise ValueError('Data has unexpected number of dimensions. Weird.')
+
+        # normalise
+        print(f'Normalizing each frame to run Stardist', flush=True)
+        print(f"Timelapse has axes {axes.replace('C','')} with shape {(T.shape[0],)+tuple(T.shape[2:])}")
+
+        roi_path = self._roi_path(file, prob_thresh, nms_thresh, out_dir)
         roi_path.parent.mkdir(parents=True, exist_ok=True)
         rois_python = Path(str(roi_path)+'.npz')
         rois_imagej = Path(str(roi_path)+'.zip')
 
-        print(f'Saving ImageJ ROIs to {rois_imagej}')
-        export_imagej_rois(str(rois_imagej), [poly['coord'] for poly in polygons])
+        # polygons are committed to the checkpoint as they are predicted, a restarted run continues after the last commit
+        checkpoint = PredictionCheckpoint(Path(str(roi_path)+'.partial'), self._checkpoint_params(model, file, T, channel, prob_thresh, nms_thresh))
+        start = checkpoint.committed()
+        if start > 0:
+            print(f'Resuming prediction from frame {start+1}/{T.shape[0]}')
+        batch_size, chunk = self.config.predict_batch_size or 1, []
+        for polygons in self._predict_frames(model, T, channel, prob_thresh, nms_thresh, file, start):
+            chunk.append(polygons)
+            if len(chunk) == batch_size:
+                checkpoint.append(start, chunk)
+                start, chunk = start + len(chunk), []
+        if chunk:
+            checkpoint.append(start, chunk)
 
+        print(f'Saving ImageJ ROIs to {rois_imagej}')
         print(f'Saving Python rois to {rois_python}')
-        np.savez(str(rois_python),
-            coord  = [p['coord']  for p in polygons],
-            points = [p['points'] for p in polygons],
-            prob   = [p['prob']   for p in polygons],
-        )
+        checkpoint.assemble(rois_python, rois_imagej, T.shape[0])
+        checkpoint.remove()
+        return [rois_imagej, rois_python]
+
+
+    def _checkpoint_params(self, model, file, T, channel, prob_thresh, nms_thresh):
+        # everything the committed polygons depend on
+        c = self.config
+        source = self._prediction_input(file)
+        return dict(input=str(source), fingerprint=file_fingerprint(source) if Path(source).exists() else None,
+                    shape=list(T.shape), channel=channel, prob_thresh=prob_thresh, nms_thresh=nms_thresh,
+                    model=model_identity(model) if getattr(model, 'logdir', None) is not None else getattr(model, 'name', None),
+                    **{k: getattr(c,k) for k in ('predict_memory_mb', 'prediction_cache_dir')})
 
 
     def predict_stardist(self, file, T):
         c = self.config
+        m = self.manifest(file)
+        inputs = [self._prediction_input(file)]
         for channel, model in self.models.items():
             stardist_model = model['model']
             channel_ind = c.channel_order.index(channel)
             prob_thresh = model['prob_thresh']
             nms_thresh = model['nms_thresh']
             out_dir = self.stardist_dir / channel
+            params = self._prediction_params(T.shape, channel)
+            if m is not None and m.up_to_date(f'prediction/{channel}', inputs, params, stardist_model):
+                print(f'\n~~ Predictions on channel {channel} are up to date ~~')
+                continue
             print(f'\n~~ Running predictions on channel {channel} ~~')
-            self._predict_stardist(stardist_model, file, T, channel_ind, prob_thresh, nms_thresh, out_dir)
+            outputs = self._predict_stardist(stardist_model, file, T, channel_ind, prob_thresh, nms_thresh, out_dir)
+            if m is not None:
+                m.record(f'prediction/{channel}', inputs, params, outputs, stardist_model)
+
+
+    def sweep_thresholds(self, file, channel, prob_threshs, nms_threshs, reference=None, iou_thresh=0.5, workers=None):
+        """Number of objects and matching statistics for a grid of (prob, nms) thresholds of a channel model.
+
+        Predicts all frames of the raw file (drift-corrected if configured) once into the prediction
+        cache, then runs only NMS for each setting, in parallel in workers processes (default: all cores).
+        reference is a .npz file of polygons (e.g. saved by predict_stardist) to compute precision,
+        recall, f1, etc. at iou_thresh (stardist.matching.matching_dataset). Returns a list of dicts.
+        """
+        from itertools import product
+        model = self.models[channel]['model']
+        cache = self._prediction_cache(model)
+        cache is not None or _raise(ValueError('set prediction_cache_dir in the config to sweep thresholds'))
+        T = self._read_tcyx(self._prediction_input(file), lazy=True)[0]
+        channel_ind = self.config.channel_order.index(channel)
+
+        print(f'Predicting {T.shape[0]} frames of channel {channel} (if not cached)')
+        keys, batch_size = [], self.config.predict_batch_size or 1
+        for i in self._tqdm(range(0, T.shape[0], batch_size)):
+            keys.extend(self._cached_maps(model, cache, np.asarray(T[i:i+batch_size,channel_ind]), file)[0])
+
+        settings = list(product(prob_threshs, nms_threshs))
+        shape = (T.shape[0],) + tuple(T.shape[2:])
+        args = (str(cache.directory), keys, shape, tuple(model.config.grid))
+        kwargs = dict(reference=None if reference is None else str(reference), iou_thresh=iou_thresh)
+        workers = min(len(settings), workers or os.cpu_count() or 1)
+        print(f'Sweeping {len(settings)} threshold settings with {workers} workers')
+        if workers <= 1:
+            results = [_sweep_setting(*args, p, n, **kwargs) for p, n in self._tqdm(settings)]
+        else:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+                futures = [pool.submit(_sweep_setting, *args, p, n, **kwargs) for p, n in settings]
+                for _ in self._tqdm(as_completed(futures), total=len(futures)):
+                    pass
+                results = [f.result() for f in futures]
+
+        for r in results:
+            stats = '' if reference is None else f"  precision {r['precision']:.3f}  recall {r['recall']:.3f}  f1 {r['f1']:.3f}"
+            print(f"prob {r['prob_thresh']:.2f}  nms {r['nms_thresh']:.2f}  {r['n_objects']:7d} objects{stats}")
+        return results
+
+
+    def track(self, file):
+        # track the polygons of the tracking channel without Fiji, writes '<image name>_tracks.csv' like TrackMate
+        from tracking import track_file
+        rois_python = self._rois_python(file)
+        m = self.manifest(file)
+        if m is not None and m.up_to_date('tracking', [rois_python], {}):
+            print('Tracks are up to date')
+            return
+        tracks_file = self.tracks_dir / f'{self._prediction_input(file).stem}_tracks.csv'
+        print(f'Tracking polygons from {rois_python}')
+        with profile('track', file):
+            track_file(rois_python, tracks_file)
+        if m is not None:
+            m.record('tracking', [rois_python], {}, [tracks_file])
+
+
+    def run(self, file):
+        # load (and drift-correct) a raw file, run predictions for all models and track if tracks_dir is set, never raises
+        try:
+            with profile('run', file):
+                if self.up_to_date(file):
+                    print(f'Results for {file} are up to date')
+                    return dict(file=str(file), success=True, error=None)
+                T = self.load_timelapse(file)
+                self.predict_stardist(file, T)
+                if self.config.tracks_dir is not None:
+                    self.track(file)
+            return dict(file=str(file), success=True, error=None)
+        except Exception as e:
+            print(f'Failed to process {file}: {e}')
+            return dict(file=str(file), success=False, error=traceback.format_exc())
+
+
+    def run_all(self, workers=1, tf_threads=None):
+        # process all raw files, with a pool of worker processes if workers > 1
+        # each worker loads the models once and uses tf_threads threads (default: split available cores)
+        files = self.raw_files
+        if workers is None or workers <= 1:
+            if not hasattr(self, 'models'):
+                self.load_models()
+            results = [self.run(file) for file in self._tqdm(files)]
+        else:
+            workers = min(workers, len(files)) or 1
+            if tf_threads is None:
+                tf_threads = max(1, (os.cpu_count() or 1) // workers)
+            print(f'Processing {len(files)} datasets with {workers} workers ({tf_threads} threads each)')
+            # spawn: tensorflow is not fork-safe
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=_init_worker, initargs=(self.config, tf_threads)) as pool:
+                futures = {pool.submit(_run_file, file): file for file in files}
+                status = {}
+                for future in self._tqdm(as_completed(futures), total=len(futures)):
+                    file = futures[future]
+                    try:
+                        status[file] = future.result()
+                    except Exception:
+                        # worker died (e.g. out of memory)
+                        status[file] = dict(file=str(file), success=False, error=traceback.format_exc())
+                results = [status[file] for file in files]
+
+        failed = [r for r in results if not r['success']]
+        print(f'Processed {len(results)-len(failed)}/{len(results)} datasets successfully')
+        for r in failed:
+            print(f"  failed: {r['file']}")
+
+        c = self.config
+        if c.profile_file is not None:
+            self.print_profile()
+            if c.trace_file is not None:
+                write_chrome_trace(self.base_dir / c.profile_file, self.base_dir / c.trace_file)
+                print(f'Saved Chrome trace to {self.base_dir / c.trace_file}')
+        return results
+
+
+    def print_profile(self):
+        # time and memory per stage, summed over all files (and runs) in profile_file
+        totals = {}
+        for s in profile_summary(Path(self.config.base_dir) / self.config.profile_file):
+            t = totals.setdefault(s['stage'], dict(wall=0.0, cpu=0.0, frames=0, peak_rss_mb=0.0))
+            t['wall'] += s['wall']; t['cpu'] += s['cpu']; t['frames'] += s['frames']
+            t['peak_rss_mb'] = max(t['peak_rss_mb'], s['peak_rss_mb'])
+        for stage, t in totals.items():
+            fps = f"{t['frames']/t['wall']:8.1f} frames/s" if t['frames'] and t['wall'] > 0 else ' '*17
+            print(f"{stage:12} {t['wall']:9.2f}s wall {t['cpu']:9.2f}s cpu {fps} {t['peak_rss_mb']:9.1f} MB peak")
+
+
+
+def _address(address):
+    # 'host:port' -> (host, port), otherwise a unix socket path (or a named pipe on Windows)
+    host, _, port = str(address).rpartition(':')
+    return (host, int(port)) if host and port.isdigit() else str(address)
+
+
+MODEL_SERVER_KEY = 'STARCHAEA_MODEL_SERVER_KEY'
+
+def _authkey(authkey=None):
+    # secret shared by ModelServer and RemoteModel: requests are pickled, whoever knows the key can run code on the server
+    authkey = os.environ.get(MODEL_SERVER_KEY) if authkey is None else authkey
+    authkey or _raise(ValueError(f'set a secret key for the model server in the environment variable {MODEL_SERVER_KEY}'))
+    return authkey.encode() if isinstance(authkey, str) else bytes(authkey)
+
+
+def _is_local(address):
+    return not isinstance(address, tuple) or address[0] in ('localhost', '127.0.0.1', '::1')
+
+
+_request = namedtuple('_request', ('key', 'frames', 'future'))
+
+
+class ModelServer:
+    """Keeps the StarDist models of a config loaded and predicts frames sent by RemoteModel clients.
+
+    Requests of all clients for the same model, frame shape and thresholds that arrive within
+    max_wait seconds are predicted together, in batches of up to max_batch frames (see
+    predict_instances_batch for when batched results are bit-identical; max_batch=1 never batches).
+
+    Clients must know the secret authkey (default: environment variable STARCHAEA_MODEL_SERVER_KEY),
+    since requests are unpickled by the server. Only unix sockets and localhost addresses are
+    served unless allow_remote is set.
+    """
+
+    def __init__(self, config, address=None, max_batch=8, max_wait=0.01, warmup_shape=(256,256), authkey=None, allow_remote=False):
+        config = Config.load(config) if isinstance(config, str) else config
+        self.address = _address(config.model_server if address is None else address)
+        allow_remote or _is_local(self.address) or _raise(ValueError(
+            f'refusing to serve at {self.address[0]}, which may be reachable from other machines (use a socket path or localhost, or allow_remote)'))
+        self.authkey = _authkey(authkey)
+        self.max_batch, self.max_wait = max(1, int(max_batch)), max_wait
+        app = Starchaea(config._replace(model_server=None))
+        app.load_models()
+        self.models = {getattr(config, name+'_model'): m['model'] for name, m in app.models.items()}
+        for name, model in self.models.items():
+            print(f'Warming up model {name}')
+            model.predict_instances(np.zeros(warmup_shape, np.float32))
+        self._requests = queue.Queue()
+
+
+    def _predict(self, name, frames, prob_thresh, nms_thresh):
+        model = self.models[name]
+        if len(frames) == 1:
+            return [model.predict_instances(frames[0], prob_thresh=prob_thresh, nms_thresh=nms_thresh)[1]]
+        return predict_instances_batch(model, frames, prob_thresh=prob_thresh, nms_thresh=nms_thresh)
+
+
+    def _run_batches(self):
+        # the only thread using the models: collect requests for up to max_wait seconds and predict them in batches
+        while True:
+            batch = [self._requests.get()]
+            deadline = time.monotonic() + self.max_wait
+            while sum(len(r.frames) for r in batch) < self.max_batch:
+                try:
+                    batch.append(self._requests.get(timeout=max(0, deadline-time.monotonic())))
+                except queue.Empty:
+                    break
+            groups = {}
+            for r in batch:
+                groups.setdefault(r.key, []).append(r)
+            for key, group in groups.items():
+                try:
+                    frames = np.concatenate([r.frames for r in group])
+                    polygons = [p for i in range(0, len(frames), self.max_batch)
+                                  for p in self._predict(key[0], frames[i:i+self.max_batch], *key[2:])]
+                    offsets = np.cumsum([0]+[len(r.frames) for r in group])
+                    for r, a, b in zip(group, offsets[:-1], offsets[1:]):
+                        r.future.set_result(polygons[a:b])
+                except Exception as e:
+                    for r in group:
+                        r.future.set_exception(e)
+
+
+    def _handle(self, conn):
+        # requests of one client: ('info', name) or ('predict', name, frames, prob_thresh, nms_thresh)
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    command, name = request[:2]
+                    name in self.models or _raise(KeyError(f"model '{name}' is not loaded by the server (models: {', '.join(self.models)})"))
+                    if command == 'info':
+                        model = self.models[name]
+                        reply = dict(name=model.name, logdir=str(model.logdir))
+                    elif command == 'predict':
+                        frames, prob_thresh, nms_thresh = request[2:]
+                        future = Future()
+                        self._requests.put(_request((name, frames.shape[1:], prob_thresh, nms_thresh), frames, future))
+                        reply = future.result()
+                    else:
+                        raise ValueError(f'unknown request {command}')
+                    conn.send(('ok', reply))
+                except Exception:
+                    conn.send(('error', traceback.format_exc()))
+
+
+    def serve_forever(self):
+        from multiprocessing.connection import Listener
+        from multiprocessing import AuthenticationError
+        threading.Thread(target=self._run_batches, daemon=True).start()
+        with Listener(self.address, authkey=self.authkey) as listener:
+            if isinstance(self.address, str) and os.path.exists(self.address):
+                # only the user of the server can connect to its socket
+                os.chmod(self.address, 0o600)
+            print(f'Serving models {", ".join(self.models)} at {self.address}')
+            while True:
+                try:
+                    conn = listener.accept()
+                except (AuthenticationError, EOFError, OSError) as e:
+                    print(f'Rejected a client: {type(e).__name__} {e}')
+                    continue
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+
+
+class RemoteModel:
+    # stands in for a StarDist2D model loaded by a ModelServer, with the same predictions
+
+    def __init__(self, address, name, authkey=None):
+        from multiprocessing.connection import Client
+        self._conn = Client(_address(address), authkey=_authkey(authkey))
+        self._lock = threading.Lock()
+        self._name = name
+        info = self._call('info', name)
+        # as StarDist2D, e.g. for model_identity
+        self.name, self.logdir = info['name'], Path(info['logdir'])
+
+
+    def _call(self, *request):
+        with self._lock:
+            self._conn.send(request)
+            status, reply = self._conn.recv()
+        if status != 'ok':
+            raise RuntimeError(f'Model server failed:\n{reply}')
+        return reply
+
+
+    def predict_instances_batch(self, frames, prob_thresh=None, nms_thresh=None):
+        return self._call('predict', self._name, np.asarray(frames, np.float32), prob_thresh, nms_thresh)
+
+
+    def predict_instances(self, img, prob_thresh=None, nms_thresh=None):
+        # only the polygons, no label image
+        return None, self.predict_instances_batch(img[np.newaxis], prob_thresh, nms_thresh)[0]
+
+
+    def close(self):
+        self._conn.close()
+
+
+
+def main(argv=None):
+    # command line interface: python -m starchaea config.json <command>
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m starchaea', description='Run stages of starchaea with a config saved by Config.save')
+    parser.add_argument('config', help='config.json (paths in it are relative to the current directory)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('config', help='show the config')
+    commands.add_parser('datasets', help='list the datasets in base_dir and their results')
+    for name, help in (('register', 'drift-correct raw files'),
+                       ('predict',  'drift-correct (if configured), predict and track (if tracks_dir is set) raw files'),
+                       ('track',    'track the predicted polygons of raw files (needs tracks_dir)')):
+        p = commands.add_parser(name, help=help)
+        p.add_argument('files', nargs='*', type=Path, help='raw files (default: all in data_dir)')
+        if name == 'predict':
+            p.add_argument('--workers', type=int, default=1, help='number of worker processes (default: %(default)s)')
+            p.add_argument('--tf-threads', type=int, default=None, help='tensorflow threads per worker')
+    p = commands.add_parser('sweep', help='objects and matching statistics for a grid of thresholds (needs prediction_cache_dir)')
+    p.add_argument('file', type=Path, help='raw file')
+    p.add_argument('--channel', default=None, help='channel model (default: channel_track)')
+    p.add_argument('--prob', type=float, nargs='+', required=True, help='probability thresholds')
+    p.add_argument('--nms', type=float, nargs='+', required=True, help='NMS thresholds')
+    p.add_argument('--reference', type=Path, default=None, help='polygons (.npz) to compare with')
+    p.add_argument('--iou', type=float, default=0.5, help='IoU threshold of matching (default: %(default)s)')
+    p.add_argument('--workers', type=int, default=None, help='number of worker processes (default: all cores)')
+    p.add_argument('--out', type=Path, default=None, help='save the results as JSON')
+    p = commands.add_parser('serve', help='keep the models loaded and predict for clients with model_server set in their config')
+    p.add_argument('--address', default=None, help="'host:port' or socket path (default: model_server of the config)")
+    p.add_argument('--max-batch', type=int, default=8, help='max. number of frames predicted together (default: %(default)s)')
+    p.add_argument('--max-wait', type=float, default=0.01, help='seconds to wait for more requests to batch (default: %(default)s)')
+    p.add_argument('--allow-remote', action='store_true', help='also serve at addresses other than localhost (anyone who can reach it and knows the key can run code)')
+    p = commands.add_parser('profile', help='summarize profile_file')
+    p.add_argument('--trace', type=Path, default=None, help='also save a Chrome trace')
+    args = parser.parse_args(argv)
+
+    config = Config.load(args.config)
+
+    if args.command == 'config':
+        for k, v in config._asdict().items():
+            print(f'{k:28} {v}')
+        return 0
+
+    if args.command == 'datasets':
+        registry = DatasetRegistry(config.base_dir, config=config)
+        for stem in registry.datasets('raw'):
+            print(stem)
+            for kind, path in sorted(registry.files(stem).items()):
+                print(f'  {kind:28} {path}')
+        return 0
+
+    if args.command == 'serve':
+        (args.address or config.model_server) is not None or _raise(ValueError('model_server is not set in the config, use --address'))
+        ModelServer(config, args.address, args.max_batch, args.max_wait, allow_remote=args.allow_remote).serve_forever()
+        return 0
+
+    if args.command == 'profile':
+        config.profile_file is not None or _raise(ValueError('profile_file is not set in the config'))
+        app = Starchaea(config)
+        app.print_profile()
+        if args.trace is not None:
+            write_chrome_trace(Path(config.base_dir) / config.profile_file, args.trace)
+            print(f'Saved Chrome trace to {args.trace}')
+        return 0
+
+    app = Starchaea(config)
+    app.init()
+    files = getattr(args, 'files', None) or app.raw_files
+
+    if args.command == 'register':
+        config.channel_drift_correction is not None or _raise(ValueError('channel_drift_correction is not set in the config'))
+        for file in files:
+            app.load_timelapse(file)
+        return 0
+
+    if args.command == 'track':
+        config.tracks_dir is not None or _raise(ValueError('tracks_dir is not set in the config'))
+        for file in files:
+            app.track(file)
+        return 0
+
+    if args.command == 'sweep':
+        app.load_models()
+        results = app.sweep_thresholds(args.file, args.channel or config.channel_track, args.prob, args.nms,
+                                       reference=args.reference, iou_thresh=args.iou, workers=args.workers)
+        if args.out is not None:
+            save_json(results, str(args.out))
+        return 0
+
+    if args.command == 'predict':
+        if args.files:
+            app.load_models()
+            results = [app.run(file) for file in tqdm(files)]
+        else:
+            results = app.run_all(workers=args.workers, tf_threads=args.tf_threads)
+        return 0 if all(r['success'] for r in results) else 1
+
+
 
+if __name__ == '__main__':
+    # import as module 'starchaea' (not '__main__'), as worker processes and tracking.py do
+    from starchaea import main
+    sys.exit(main())
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the modules are not installed, import them from the repository
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
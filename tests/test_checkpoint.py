@@ -0,0 +1,35 @@
+import zipfile
+
+import numpy as np
+import pytest
+
+from starchaea import PolygonStore, PredictionCheckpoint, export_imagej_rois
+
+pytest.importorskip('stardist')
+
+
+def _prediction(rng, n):
+    # stardist prediction dict with n polygons
+    return dict(coord  = rng.uniform(0, 100, (n,2,16)).astype(np.float32),
+                points = rng.integers(0, 100, (n,2)).astype(np.int32),
+                prob   = rng.uniform(0.5, 1, n).astype(np.float32))
+
+
+def _members(file):
+    # names and contents of the files in a zip archive (the timestamps may differ)
+    with zipfile.ZipFile(str(file)) as z:
+        return [(info.filename, info.compress_type, z.read(info)) for info in z.infolist()]
+
+
+def test_assemble(tmp_path):
+    rng = np.random.default_rng(0)
+    polygons = [_prediction(rng, n) for n in (3, 0, 5, 1, 4, 2, 0)]
+    checkpoint = PredictionCheckpoint(tmp_path/'x.partial', dict(prob_thresh=0.5))
+    for start in range(0, len(polygons), 3):
+        checkpoint.append(start, polygons[start:start+3])
+    checkpoint.assemble(tmp_path/'x.npz', tmp_path/'x.zip', len(polygons))
+
+    PolygonStore.from_polygons(polygons).save(tmp_path/'expected.npz')
+    export_imagej_rois(str(tmp_path/'expected.zip'), [p['coord'] for p in polygons])
+    assert _members(tmp_path/'x.npz') == _members(tmp_path/'expected.npz')
+    assert _members(tmp_path/'x.zip') == _members(tmp_path/'expected.zip')
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+import tifffile
+
+from starchaea import Config, Starchaea, enable_profiling, read_profile
+
+zarr = pytest.importorskip('zarr')
+
+
+def _app(base_dir, **kwargs):
+    d = {f: Config._field_defaults.get(f) for f in Config._fields}
+    d.update(base_dir=str(base_dir), data_dir='raw data', registered_dir='registered data', results_dir='stardist results',
+             channel_order=['membrane','dna'], channels_segment=['membrane'], channel_track='membrane',
+             drift_correction_backend='phase', manifest_dir=None)
+    d.update(kwargs)
+    app = Starchaea(Config(**d), progress=False)
+    app.init()
+    return app
+
+
+@pytest.fixture
+def compressed(tmp_path):
+    # zlib-compressed TCYX timelapse, which cannot be memory-mapped (read lazily with zarr)
+    rng = np.random.default_rng(0)
+    x = rng.integers(0, 1000, (5,2,48,40), dtype=np.uint16)
+    (tmp_path / 'raw data').mkdir()
+    tifffile.imwrite(str(tmp_path / 'raw data' / 'x.tif'), x, imagej=True, metadata={'axes':'TCYX'}, compression='zlib')
+    return tmp_path, x
+
+
+def test_load_compressed_lazily(compressed, tmp_path):
+    base_dir, x = compressed
+    enable_profiling(tmp_path / 'profile.jsonl')
+    try:
+        app = _app(base_dir, lazy_loading=True)
+        T = app.load_timelapse(app.raw_files[0])
+    finally:
+        enable_profiling(None)
+    assert T.shape == x.shape
+    assert np.array_equal(np.asarray(T[1:3]), x[1:3])
+    assert [r['frames'] for r in read_profile(tmp_path / 'profile.jsonl') if r['stage'] == 'load'] == [len(x)]
+
+
+def test_drift_correction_lazily(compressed):
+    base_dir, x = compressed
+    app = _app(base_dir, lazy_loading=True, channel_drift_correction='membrane')
+    T_lazy = np.asarray(app.load_timelapse(app.raw_files[0]))
+    app = _app(base_dir, lazy_loading=False, channel_drift_correction='membrane')
+    T = app.load_timelapse(app.raw_files[0])
+    assert np.array_equal(T_lazy, T)
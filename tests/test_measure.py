@@ -0,0 +1,38 @@
+import numpy as np
+from skimage.draw import polygon
+from skimage.measure import regionprops
+from tifffile import imwrite
+
+from starchaea import PolygonStore, measure_crop
+
+
+def _star(rng, center, n_rays=32):
+    phi = np.linspace(0, 2*np.pi, n_rays, endpoint=False)
+    dist = rng.uniform(6, 12) * (1 + 0.3*np.cos(2*phi + rng.uniform(0, np.pi)))
+    return np.stack([center[0] + dist*np.sin(phi), center[1] + dist*np.cos(phi)]).astype(np.float32)
+
+
+def test_measure_crop_exact(tmp_path):
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 1000, (4,64,80)).astype(np.uint16)
+    # 1, 2 and 3 (non-overlapping) polygons per frame
+    coord = [[_star(rng, c) for c in centers] for centers in
+             ([(20,20)], [(20,20),(40,56)], [(16,16),(44,60),(20,56)], [(30,40)])]
+    imwrite(str(tmp_path/'crop.tif'), image, photometric='minisblack')
+    PolygonStore.from_lists(coord).save(tmp_path/'crop.npz')
+
+    frames = measure_crop(tmp_path/'crop.tif', tmp_path/'crop.npz', exact=True)
+    approx = measure_crop(tmp_path/'crop.tif', tmp_path/'crop.npz')
+    for t, frame in enumerate(frames):
+        assert frame['frame'] == t and len(frame['tracked']) == min(2, len(coord[t]))
+        for f, g in zip(frame['tracked'], approx[t]['tracked']):
+            # the same polygon as the approximate measurement, with the regionprops of its mask
+            c = next(c for c in coord[t] if np.allclose(np.mean(c,axis=1), g['c'], atol=1))
+            mask = np.zeros(image.shape[1:], np.uint8)
+            mask[polygon(c[0], c[1], mask.shape)] = 1
+            props = regionprops(mask)[0]
+            np.testing.assert_allclose(f['c'], props.centroid)
+            assert f['area'] == props.area
+            np.testing.assert_allclose([f['ecc'], f['maj'], f['min']],
+                                       [props.eccentricity, props.axis_major_length, props.axis_minor_length])
+            assert f['sig'] == g['sig'] == np.mean(image[t][mask > 0])
@@ -0,0 +1,18 @@
+import numpy as np
+import pytest
+from csbdeep.utils import normalize
+
+from starchaea import normalize_timelapse, timelapse_percentiles
+
+
+@pytest.mark.parametrize('dtype,lo,hi', [(np.uint8, 0, 256), (np.uint16, 100, 4000), (np.uint16, 0, 65536), (np.int16, -500, 500)])
+def test_histogram_percentiles(dtype, lo, hi):
+    # integer data is normalized from per-image histograms, which must agree with csbdeep's normalize (np.percentile)
+    rng = np.random.default_rng(0)
+    x = rng.integers(lo, hi, (5,2,33,47)).astype(dtype)
+    mi, ma = timelapse_percentiles(x, 1, 99.8, chunk_size=2)
+    np.testing.assert_allclose(mi, np.percentile(x, 1, axis=(-2,-1), keepdims=True), rtol=1e-12)
+    np.testing.assert_allclose(ma, np.percentile(x, 99.8, axis=(-2,-1), keepdims=True), rtol=1e-12)
+    for clip in (False, True):
+        expected = np.stack([[normalize(img, 1, 99.8, clip=clip) for img in frame] for frame in x])
+        np.testing.assert_allclose(normalize_timelapse(x, 1, 99.8, clip=clip, chunk_size=2), expected, rtol=1e-6, atol=1e-6)
@@ -0,0 +1,34 @@
+import numpy as np
+from skimage.draw import polygon
+
+from starchaea import rasterize_polygons
+
+
+def _polygons(rng, shape, n):
+    # star-convex polygons of random size, partly outside of the image, some with vertices on pixel centers
+    phi = np.linspace(0, 2*np.pi, 32, endpoint=False)
+    coord = []
+    for k in range(n):
+        center = rng.uniform(-5, np.array(shape)+5)
+        dist = rng.uniform(1, 15, len(phi))
+        c = center[:,np.newaxis] + dist*np.stack([np.sin(phi), np.cos(phi)])
+        if k % 3 == 0:
+            c = np.round(c)
+        coord.append(c)
+    # axis-aligned rectangle with integer vertices, i.e. horizontal edges on pixel rows
+    coord.append(np.array([[10,10,20,20],[5,30,30,5]], float))
+    return coord
+
+
+def test_same_as_skimage():
+    rng = np.random.default_rng(0)
+    shape = (3,50,60)
+    coord = _polygons(rng, shape[1:], 60)
+    frame = rng.integers(0, shape[0], len(coord))
+    expected_mask, expected_ids = np.zeros(shape, np.uint8), np.zeros(shape, np.uint16)
+    for k, (c, t) in enumerate(zip(coord, frame)):
+        rr, cc = polygon(c[0], c[1], shape[1:])
+        expected_mask[t, rr, cc] = 255
+        expected_ids[t, rr, cc] = k+1
+    np.testing.assert_array_equal(rasterize_polygons(coord, frame, shape), expected_mask)
+    np.testing.assert_array_equal(rasterize_polygons(coord, frame, shape, instance_ids=True), expected_ids)
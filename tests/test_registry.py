@@ -0,0 +1,44 @@
+from starchaea import Config, DatasetRegistry
+
+
+def _touch(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b'')
+
+
+def _config(base_dir, **kwargs):
+    d = {f: None for f in Config._fields}
+    d.update(base_dir=str(base_dir), data_dir='raw data', registered_dir='registered data', results_dir='stardist results')
+    d.update(kwargs)
+    return Config(**d)
+
+
+def test_single_channel_rois(tmp_path):
+    # layout written by Starchaea for a single-colour dataset: <results_dir>/<channel>/<stem>_prob=..._nms=....npz
+    _touch(tmp_path / 'raw data' / 'x.tif')
+    _touch(tmp_path / 'stardist results' / 'membrane' / 'x_prob=0.50_nms=0.40.npz')
+    _touch(tmp_path / 'stardist results' / 'membrane' / 'x_prob=0.50_nms=0.40.zip')
+    registry = DatasetRegistry(tmp_path, config=_config(tmp_path))
+    assert registry.path('x', 'rois_python') == registry.path('x', 'rois_python/membrane')
+    assert registry.path('x', 'rois_imagej').name == 'x_prob=0.50_nms=0.40.zip'
+
+
+def test_two_channel_rois(tmp_path):
+    _touch(tmp_path / 'raw data' / 'x.tif')
+    _touch(tmp_path / 'registered data' / 'DRIFTCORRECTED_x.tif')
+    for channel in ('channel 1', 'channel 2'):
+        _touch(tmp_path / 'stardist results' / channel / 'DRIFTCORRECTED_x_prob=default_nms=default.npz')
+    _touch(tmp_path / 'tracking results' / 'DRIFTCORRECTED_x_tracks.csv')
+    registry = DatasetRegistry(tmp_path)
+    files = registry.files('x')
+    assert sorted(files) == ['raw', 'registered', 'rois_python/channel 1', 'rois_python/channel 2', 'tracks']
+
+
+def test_config_dirs(tmp_path):
+    config = _config(tmp_path, data_dir='input', results_dir='out/stardist', tracks_dir='out/tracks')
+    _touch(tmp_path / 'input' / 'x.tif')
+    _touch(tmp_path / 'out' / 'stardist' / 'dna' / 'x_prob=0.50_nms=0.40.npz')
+    _touch(tmp_path / 'out' / 'tracks' / 'x_tracks.csv')
+    registry = DatasetRegistry(tmp_path, config=config)
+    assert sorted(registry.files('x')) == ['raw', 'rois_python', 'rois_python/dna', 'tracks']
+    assert registry.datasets('tracks') == ['x']
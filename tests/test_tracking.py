@@ -0,0 +1,33 @@
+"""
+Agreement of tracking.py with reference tracks in the format of the Fiji/TrackMate scripts.
+
+data/reference_polygons.npz has 12 frames of well separated synthetic cells (circles on straight
+paths, in random order within each frame): one that never divides (removed by the NUMBER_SPLITS
+filter), cells dividing in frames 5, 7 and 8, one appearing in frame 6, and a daughter missing in
+frame 9 (gap closing). data/reference_tracks.csv is not TrackMate output: it holds the ground truth
+tracks of the cells that pass the filter (each mother with both daughters), written when the
+polygons were generated. Both can be replaced by polygons and tracks exported from Fiji.
+"""
+
+from pathlib import Path
+
+from tracking import load_polygons, load_tracks, save_tracks, track_agreement, track_file, track_polygons
+
+
+DATA = Path(__file__).parent / 'data'
+
+
+def test_agreement_with_reference():
+    tracks = track_polygons(load_polygons(DATA / 'reference_polygons.npz'))
+    agreement = track_agreement(tracks, load_tracks(DATA / 'reference_tracks.csv'))
+    assert agreement['n_tracks'] == agreement['n_reference']
+    assert agreement['identical'] == 1
+    assert agreement['mean_jaccard'] == 1
+    assert agreement['precision'] == 1 and agreement['recall'] == 1
+
+
+def test_tracks_csv(tmp_path):
+    tracks = track_file(DATA / 'reference_polygons.npz', tmp_path / 'tracks.csv')
+    assert load_tracks(tmp_path / 'tracks.csv') == tracks
+    save_tracks(tracks, tmp_path / 'again.csv')
+    assert (tmp_path / 'again.csv').read_text() == (tmp_path / 'tracks.csv').read_text()
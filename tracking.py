@@ -0,0 +1,233 @@
+"""
+Headless LAP tracking of StarDist polygons, following the configuration of
+TrackMate's SparseLAPTracker in segment_n_track.py/my_tracking.py:
+
+1. frame-to-frame linking of centroids (squared distance costs, max. distance 10)
+2. closing of gaps (max. 3 frames, max. distance 15) and splitting (max. distance 7)
+   between the track segments from step 1
+3. only tracks with at least one split event are kept (NUMBER_SPLITS > 0.9)
+
+Both LAPs use TrackMate's default alternative cost (1.05 x the 90th percentile of
+all candidate costs). Spots are polygon centroids instead of the (intensity-weighted)
+centers of mass that Fiji measures, so links can differ in borderline cases.
+
+Tracks are written in the same format as the Fiji scripts, one track per line
+with the names of its ImageJ ROIs, e.g. '001_004, 002_003, ...'.
+"""
+
+import csv
+import time
+import numpy as np
+from pathlib import Path
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+from starchaea import load_polygons
+
+
+LINKING_MAX_DISTANCE     = 10.0
+GAP_CLOSING_MAX_DISTANCE = 15.0
+MAX_FRAME_GAP            = 3
+SPLITTING_MAX_DISTANCE   = 7.0
+ALTERNATIVE_COST_FACTOR  = 1.05
+CUTOFF_PERCENTILE        = 0.9
+MIN_SPLITS               = 1
+
+
+
+def _percentile(x, p):
+    # nearest rank, like imglib2's Util.percentile used by TrackMate
+    x = np.sort(x)
+    return x[int(np.clip(np.floor((len(x)-1)*p + 0.5), 0, len(x)-1))]
+
+
+def _candidates(a, b, max_distance):
+    # all pairs (i,j) of points a[i], b[j] within max_distance, with squared distances as costs
+    if len(a) == 0 or len(b) == 0:
+        return np.zeros(0,int), np.zeros(0,int), np.zeros(0)
+    d = cKDTree(a).sparse_distance_matrix(cKDTree(b), max_distance, output_type='ndarray')
+    return d['i'], d['j'], d['v']**2
+
+
+def solve_lap(n_rows, n_cols, rows, cols, costs, alternative_cost_factor=ALTERNATIVE_COST_FACTOR, cutoff_percentile=CUTOFF_PERCENTILE):
+    """Linear assignment of rows to cols (or to nothing) for sparse candidate costs.
+
+    Solves the augmented cost matrix of Jaqaman et al. (2008) as built by TrackMate:
+    leaving a row or column unassigned costs the alternative cost, the lower right
+    block is the transposed candidate pattern filled with the minimal cost.
+    Each connected component of the candidate graph is solved separately.
+    Returns the indices of the assigned candidates.
+    """
+    if len(costs) == 0:
+        return np.zeros(0,int)
+    alt = alternative_cost_factor * _percentile(costs, cutoff_percentile)
+    min_cost = np.min(costs)
+
+    graph = coo_matrix((np.ones(len(costs)), (rows, n_rows+cols)), shape=(n_rows+n_cols,)*2)
+    _, label = connected_components(graph, directed=False)
+
+    # components with a single candidate: link if cheaper than leaving both unassigned
+    n_candidates = np.bincount(label[rows])[label[rows]]
+    assigned = list(np.flatnonzero((n_candidates == 1) & (costs + min_cost < 2*alt)))
+
+    multiple = np.flatnonzero(n_candidates > 1)
+    order = multiple[np.argsort(label[rows][multiple], kind='stable')]
+    for group in np.split(order, np.flatnonzero(np.diff(label[rows][order]))+1) if len(order) else ():
+        r, r_inv = np.unique(rows[group], return_inverse=True)
+        c, c_inv = np.unique(cols[group], return_inverse=True)
+        nr, nc = len(r), len(c)
+        m = np.full((nr+nc, nc+nr), np.inf)
+        m[r_inv, c_inv] = costs[group]
+        m[np.arange(nr), nc+np.arange(nr)] = alt
+        m[nr+np.arange(nc), np.arange(nc)] = alt
+        m[nr+c_inv, nc+r_inv] = min_cost
+        row_ind, col_ind = linear_sum_assignment(m)
+        link = (row_ind < nr) & (col_ind < nc)
+        lookup = {(i,j): k for i,j,k in zip(r_inv, c_inv, group)}
+        assigned.extend(lookup[i,j] for i,j in zip(row_ind[link], col_ind[link]))
+    return np.array(sorted(assigned), int)
+
+
+def _segments(n_spots, edges):
+    # connected chains of spots after frame-to-frame linking
+    if len(edges) == 0:
+        return np.arange(n_spots)
+    edges = np.asarray(edges)
+    graph = coo_matrix((np.ones(len(edges)), (edges[:,0], edges[:,1])), shape=(n_spots,n_spots))
+    return connected_components(graph, directed=False)[1]
+
+
+def track_polygons(polygons, link_dist=LINKING_MAX_DISTANCE, gap_close_dist=GAP_CLOSING_MAX_DISTANCE,
+                   max_frame_gap=MAX_FRAME_GAP, split_dist=SPLITTING_MAX_DISTANCE, min_splits=MIN_SPLITS):
+    """Track the polygon centroids of a PolygonStore.
+
+    Returns a list of tracks, each a list of (frame, index) of its polygons,
+    sorted by frame and index. Tracks are ordered by their first polygon.
+    """
+    centroid = np.asarray(polygons.centroid, np.float64)
+    frame = np.asarray(polygons.frame)
+    offsets = np.asarray(polygons.frame_offsets)
+    n_frames, n_spots = len(polygons), len(centroid)
+
+    # 1. frame-to-frame linking
+    edges = []
+    for t in range(n_frames-1):
+        a, b = slice(offsets[t],offsets[t+1]), slice(offsets[t+1],offsets[t+2])
+        i, j, cost = _candidates(centroid[a], centroid[b], link_dist)
+        k = solve_lap(a.stop-a.start, b.stop-b.start, i, j, cost)
+        edges.extend(zip(a.start+i[k], b.start+j[k]))
+
+    # 2. gap closing and splitting between segments
+    segment = _segments(n_spots, edges)
+    order = np.lexsort((frame, segment))
+    first = np.r_[True, segment[order][1:] != segment[order][:-1]]
+    last = np.r_[first[1:], True]
+    starts, ends = order[first], order[last]
+    middles = order[~first & ~last]
+    # row/column in the cost matrix: rows are ends, then middles; columns are starts
+    row, col = np.full(n_spots, -1), np.full(n_spots, -1)
+    row[ends], row[middles], col[starts] = np.arange(len(ends)), len(ends)+np.arange(len(middles)), np.arange(len(starts))
+
+    rows, cols, costs = [], [], []
+    # gap closing: segment end -> segment start up to max_frame_gap frames later
+    for dt in range(1, max_frame_gap+1):
+        for t in range(n_frames-dt):
+            _ends, _starts = ends[frame[ends]==t], starts[frame[starts]==t+dt]
+            i, j, cost = _candidates(centroid[_ends], centroid[_starts], gap_close_dist)
+            rows.append(row[_ends[i]]); cols.append(col[_starts[j]]); costs.append(cost)
+    # splitting: middle point of a segment -> segment start in the next frame
+    for t in range(n_frames-1):
+        _middles, _starts = middles[frame[middles]==t], starts[frame[starts]==t+1]
+        i, j, cost = _candidates(centroid[_middles], centroid[_starts], split_dist)
+        rows.append(row[_middles[i]]); cols.append(col[_starts[j]]); costs.append(cost)
+
+    rows, cols, costs = (np.concatenate(v) if len(v) else np.zeros(0,int) for v in (rows, cols, costs))
+    k = solve_lap(len(ends)+len(middles), len(starts), rows, cols, costs)
+    sources = np.concatenate([ends, middles])
+    edges.extend(zip(sources[rows[k]], starts[cols[k]]))
+
+    # 3. tracks and NUMBER_SPLITS filter
+    if len(edges) == 0:
+        return []
+    edges = np.asarray(edges)
+    label = _segments(n_spots, edges)
+    successors = np.bincount(edges[:,0], minlength=n_spots)
+    n_splits = np.bincount(label, weights=successors > 1)
+    in_track = np.zeros(n_spots, bool)
+    in_track[edges.ravel()] = True
+
+    tracks = {}
+    for s in np.flatnonzero(in_track & (n_splits[label] >= min_splits)):
+        tracks.setdefault(label[s],[]).append((int(frame[s]), int(s-offsets[frame[s]])))
+    return sorted(tracks.values())
+
+
+def roi_name(frame, index):
+    # name of the ImageJ ROI as written by stardist.export_imagej_rois
+    return f'{frame+1:03d}_{index+1:03d}'
+
+
+def save_tracks(tracks, path):
+    with open(str(path), 'w') as f:
+        f.writelines([', '.join(roi_name(*roi) for roi in track)+'\n' for track in tracks])
+
+
+def load_tracks(path):
+    # as in Process_trackmate.ipynb: parse FRAME_INDEX roi names as (frame, index) tuples
+    tracks = []
+    with open(str(path)) as _f:
+        for row in csv.reader(_f, delimiter=','):
+            tracks.append([tuple(int(v)-1 for v in r.strip().split('_')) for r in row])
+    return tracks
+
+
+def track_agreement(tracks, reference):
+    """Compare tracks with reference tracks (e.g. from TrackMate).
+
+    Every reference track is matched to the track that shares most of its polygons.
+    Returns the fraction of identical tracks, the mean Jaccard index of the matched
+    tracks and precision/recall of the set of tracked polygons.
+    """
+    tracks = [set(t) for t in tracks]
+    reference = [set(t) for t in reference]
+    owner = {roi: i for i,t in enumerate(tracks) for roi in t}
+    jaccard = []
+    for ref in reference:
+        shared = np.bincount([owner[roi] for roi in ref if roi in owner], minlength=len(tracks))
+        i = np.argmax(shared) if len(tracks) else None
+        jaccard.append(0 if i is None or shared[i] == 0 else shared[i] / len(ref | tracks[i]))
+    tracked, tracked_ref = set().union(*tracks), set().union(*reference)
+    n_shared = len(tracked & tracked_ref)
+    return dict (
+        n_tracks     = len(tracks),
+        n_reference  = len(reference),
+        identical    = float(np.mean(np.equal(jaccard,1))) if reference else float('nan'),
+        mean_jaccard = float(np.mean(jaccard)) if reference else float('nan'),
+        precision    = n_shared / len(tracked) if tracked else float('nan'),
+        recall       = n_shared / len(tracked_ref) if tracked_ref else float('nan'),
+    )
+
+
+def track_file(rois_python, path, **kwargs):
+    # track the polygons of a stardist .npz file and save the tracks as csv
+    polygons = load_polygons(rois_python)
+    t = time.time()
+    tracks = track_polygons(polygons, **kwargs)
+    print(f'Found {len(tracks)} tracks in {len(polygons)} frames ({len(polygons.coord)} polygons, {time.time()-t:.2f}s)')
+    save_tracks(tracks, path)
+    return tracks
+
+
+
+if __name__ == '__main__':
+    # benchmark on existing polygons and compare with tracks from Fiji/TrackMate, e.g.
+    # python tracking.py "stardist results/membrane/x_prob=default_nms=0.70.npz" "tracking results/DRIFTCORRECTED_x_tracks.csv"
+    import sys
+    rois_python, reference = sys.argv[1], (sys.argv[2] if len(sys.argv) > 2 else None)
+    out = Path(rois_python).with_name(Path(rois_python).stem + '_tracks.csv')
+    tracks = track_file(rois_python, out)
+    print(f'Saved tracks to {out}')
+    if reference is not None:
+        print(track_agreement(tracks, load_tracks(reference)))